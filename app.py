@@ -1,10 +1,53 @@
 import os
+import re
 import uuid
-from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify
+import io
+import csv
+import base64
+import binascii
+import hashlib
+import json
+import math
+import glob
+import pickle
+import sqlite3
+import functools
+import time
+import random
+import threading
+import click
+import socket
+import socketserver
+from bisect import bisect_left
+from itertools import chain
+from collections import OrderedDict
+from urllib.parse import urlencode
+import tempfile
+from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify, abort, make_response, Response, stream_with_context, g, has_app_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event, Select
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.engine import Engine
+from flask_mail import Mail, Message
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from markupsafe import Markup
+from datetime import datetime, timedelta, date, timezone
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it KYC thumbnails are skipped
+    Image = None
+try:
+    import fcntl
+except ImportError:  # Not on Windows; there the hashing limit applies per worker process
+    fcntl = None
+try:
+    import numpy as np
+except ImportError:  # In requirements.txt; without it fleet analytics fall back to plain Python loops
+    np = None
 
 # --- Configuration ---
 app = Flask(__name__)
@@ -12,17 +55,67 @@ app.config['SECRET_KEY'] = 'drivex-secret-key-2026'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
 
 # Database Configuration
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    if database_url.startswith("postgres://"):
-        database_url = database_url.replace("postgres://", "postgresql://", 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///drivex.db'
+def database_uri(url):
+    return url.replace("postgres://", "postgresql://", 1) if url.startswith("postgres://") else url
+
+def engine_options(url, prefix):
+    # Pool size and pre-ping are set per bind, e.g. DATABASE_POOL_SIZE / DATABASE_REPLICA_POOL_SIZE
+    options = {'pool_pre_ping': os.environ.get(f'{prefix}_PRE_PING', '1') == '1'}
+    if not (url.startswith('sqlite') and (':memory:' in url or url.rstrip('/') == 'sqlite:' or 'mode=memory' in url)):
+        options['pool_size'] = int(os.environ.get(f'{prefix}_POOL_SIZE', 5))
+        options['max_overflow'] = int(os.environ.get(f'{prefix}_MAX_OVERFLOW', 10))
+    return options
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(os.environ.get('DATABASE_URL') or 'sqlite:///drivex.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], 'DATABASE')
+# Optional read replica for admin and reporting pages; reads fall back to the primary when it lags
+replica_url = os.environ.get('DATABASE_REPLICA_URL')
+if replica_url:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': dict(url=database_uri(replica_url), **engine_options(replica_url, 'DATABASE_REPLICA'))}
+app.config['DATABASE_REPLICA_MAX_LAG'] = float(os.environ.get('DATABASE_REPLICA_MAX_LAG', 10))
+app.config['DATABASE_REPLICA_CHECK_SECONDS'] = float(os.environ.get('DATABASE_REPLICA_CHECK_SECONDS', 5))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+# Password hashing is limited per host: lock files in HASH_SLOT_DIR are shared by every gunicorn worker
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 2))
+# Keep the queue limit below the gunicorn worker count, or every worker can end up waiting on a hash
+app.config['HASH_QUEUE_LIMIT'] = int(os.environ.get('HASH_QUEUE_LIMIT', 3))
+app.config['HASH_WAIT_SECONDS'] = float(os.environ.get('HASH_WAIT_SECONDS', 0.5))
+app.config['HASH_SLOT_DIR'] = os.environ.get('HASH_SLOT_DIR', os.path.join(tempfile.gettempdir(), 'drivex-hash-slots'))
+app.config['HOLD_MINUTES'] = int(os.environ.get('HOLD_MINUTES', 15))
+app.config['QUOTE_MINUTES'] = int(os.environ.get('QUOTE_MINUTES', 30))
+# 'memory' (per-worker LRU), 'sqlite:/path/to/cache.db' (shared by workers on one host) or 'off'
+app.config['RESPONSE_CACHE'] = os.environ.get('RESPONSE_CACHE', 'memory')
+app.config['RESPONSE_CACHE_BYTES'] = int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+# Workers share request metrics through per-process snapshot files in METRICS_DIR (optional)
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 0))
+# Outgoing mail; the defaults point at `flask smtp-sink` for local runs
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'localhost')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 1025))
+app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS') == '1'
+app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'DriveX <no-reply@drivex.com>')
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_BACKOFF_SECONDS'] = int(os.environ.get('JOB_BACKOFF_SECONDS', 30))
+app.config['JOB_TIMEOUT_SECONDS'] = int(os.environ.get('JOB_TIMEOUT_SECONDS', 600))
+# How often an idle `flask worker` runs the booking lifecycle sweep; 0 leaves it to cron
+app.config['LIFECYCLE_SWEEP_SECONDS'] = int(os.environ.get('LIFECYCLE_SWEEP_SECONDS', 300))
+# Chatbot intents and answers; edits are picked up without a restart
+app.config['CHATBOT_INTENTS'] = os.environ.get('CHATBOT_INTENTS', os.path.join(app.root_path, 'chatbot_intents.json'))
+
+class RoutingSession(FlaskSession):
+    # Plain reads inside a replica_reads() scope go to the 'replica' bind; flushes and DML never do
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and (clause is None or isinstance(clause, Select)) and replica_router.active():
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+mail = Mail(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.session_protection = "strong"
@@ -36,34 +129,51 @@ class User(UserMixin, db.Model):
     phone = db.Column(db.String(20))
     address = db.Column(db.String(200))
     gov_id = db.Column(db.String(50)) 
-    gov_id_image = db.Column(db.Text) 
-    user_selfie = db.Column(db.Text) 
-    kyc_status = db.Column(db.String(20), default='Unverified')
+    gov_id_image = db.Column(db.String(64), db.ForeignKey('kyc_image.digest'))
+    user_selfie = db.Column(db.String(64), db.ForeignKey('kyc_image.digest'))
+    kyc_status = db.Column(db.String(20), default='Unverified', index=True)
     is_admin = db.Column(db.Boolean, default=False)
     session_token = db.Column(db.String(100), nullable=True) 
 
+# KYC uploads are stored once per content hash and only loaded when served
+class KycImage(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)
+    mime_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    data = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    # Small JPEG preview made by the 'kyc_thumbnail' job; the original bytes are never rewritten
+    thumbnail = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    date_uploaded = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Car(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    category = db.Column(db.String(50))
+    category = db.Column(db.String(50), index=True)
     price_per_hr = db.Column(db.Integer, nullable=False)
     image_url = db.Column(db.String(500), nullable=False)
     transmission = db.Column(db.String(20))
-    fuel_type = db.Column(db.String(20))
-    seats = db.Column(db.Integer)
+    fuel_type = db.Column(db.String(20), index=True)
+    seats = db.Column(db.Integer, index=True)
     is_available = db.Column(db.Boolean, default=True)
     location = db.Column(db.String(50), default='Mumbai')
+    # Running aggregates of Review.rating, kept in step by submit_review
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
     reviews = db.relationship('Review', backref='car', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_car_available_location', 'is_available', 'location'),
+    )
+
     @property
     def average_rating(self):
-        if not self.reviews: return 5.0
-        return round(sum([r.rating for r in self.reviews]) / len(self.reviews), 1)
+        if not self.rating_count: return 5.0
+        return round(self.rating_sum / self.rating_count, 1)
 
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    car_id = db.Column(db.Integer, db.ForeignKey('car.id'))
+    car_id = db.Column(db.Integer, db.ForeignKey('car.id'), index=True)
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.String(500))
     date_posted = db.Column(db.DateTime, default=datetime.utcnow)
@@ -74,6 +184,24 @@ class Coupon(db.Model):
     code = db.Column(db.String(20), unique=True, nullable=False)
     discount_amount = db.Column(db.Integer, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
+    # Optional limits; NULL means no limit. redemptions only moves through redeem_coupon()
+    starts_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    max_redemptions = db.Column(db.Integer, nullable=True)
+    per_user_limit = db.Column(db.Integer, nullable=True)
+    redemptions = db.Column(db.Integer, default=0, nullable=False)
+
+class CouponRedemption(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    coupon_id = db.Column(db.Integer, db.ForeignKey('coupon.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))
+    date_redeemed = db.Column(db.DateTime, default=datetime.utcnow)
+    booking = db.relationship('Booking')
+
+    __table_args__ = (
+        db.Index('ix_coupon_redemption_user', 'coupon_id', 'user_id'),
+    )
 
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -92,18 +220,1002 @@ class Booking(db.Model):
     total_cost = db.Column(db.Integer)
     with_driver = db.Column(db.Boolean, default=False)
     payment_method = db.Column(db.String(30))
+    coupon_code = db.Column(db.String(20), nullable=True)
     start_date = db.Column(db.DateTime)
     end_date = db.Column(db.DateTime)
     date_booked = db.Column(db.DateTime, default=datetime.utcnow)
     car = db.relationship('Car')
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_booking_car_dates', 'car_id', 'start_date', 'end_date'),
+        db.Index('ix_booking_user_date', 'user_id', 'date_booked'),
+        db.Index('ix_booking_date_booked', 'date_booked', 'id'),
+        db.Index('ix_booking_status_end', 'status', 'end_date'),
+    )
+
+# A car's dates are reserved for one user between quote and payment
+class BookingHold(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    car_id = db.Column(db.Integer, db.ForeignKey('car.id'), nullable=False)
+    start_date = db.Column(db.DateTime, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_booking_hold_car_dates', 'car_id', 'start_date', 'end_date'),
+    )
+
+# Dashboard rollups, updated in the same transaction as the rows they summarize
+class StatCounter(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger, default=0, nullable=False)
+
+class DailyStat(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    location = db.Column(db.String(50), primary_key=True)
+    bookings = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.BigInteger, default=0, nullable=False)
+
+# One row per lifecycle sweep, so the dashboard can show when bookings were last moved along
+class LifecycleRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    ran_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    activated = db.Column(db.Integer, default=0)
+    completed = db.Column(db.Integer, default=0)
+    seconds = db.Column(db.Float, default=0)
+
+# Shared change stamps so every worker can tell when its in-process caches are stale
+class DataVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.String(32), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Replica lag is measured from these stamps
+
+def get_version(name):
+    return db.session.query(DataVersion.version).filter_by(name=name).scalar() or ''
+
+def bump_version(name):
+    # Runs inside the caller's transaction, so the stamp changes exactly when the data commits
+    version = uuid.uuid4().hex
+    now = datetime.utcnow()
+    updated = db.session.execute(db.update(DataVersion).where(DataVersion.name == name).values(version=version, updated_at=now)).rowcount
+    if not updated: db.session.add(DataVersion(name=name, version=version, updated_at=now))
+    return version
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='Queued', nullable=False) # Queued, Running, Done, Skipped, Failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+class VersionedCache:
+    # Holds one computed value per worker and recomputes it after bump_version(name)
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.version = None
+        self.value = None
+
+    def get(self):
+        return self.get_with_version()[0]
+
+    def get_with_version(self):
+        version = get_version(self.name)
+        with self.lock:
+            if self.version != version:
+                self.value, self.version = self.loader(), version
+            return self.value, version
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+
+# --- Read Replica ---
+# Admin and reporting views run inside replica_reads(): their SELECTs go to DATABASE_REPLICA_URL
+# while the replica is reachable and no more than DATABASE_REPLICA_MAX_LAG seconds behind.
+# Lag is the age of the oldest DataVersion stamp the replica has not received yet, so
+# a replica that stops applying changes is dropped as soon as bookings, cars, coupons or reviews move on.
+class ReplicaRouter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_at = 0.0
+        self.ok = False
+        self.lag = None
+
+    def configured(self):
+        return 'replica' in app.config.get('SQLALCHEMY_BINDS', {})
+
+    def active(self):
+        return has_app_context() and g.get('replica_reads', False)
+
+    def healthy(self):
+        if not self.configured(): return False
+        with self.lock:
+            if time.monotonic() - self.checked_at < app.config['DATABASE_REPLICA_CHECK_SECONDS']:
+                return self.ok
+            self.checked_at = time.monotonic()
+            try:
+                self.lag = self.measure_lag()
+                self.ok = self.lag <= app.config['DATABASE_REPLICA_MAX_LAG']
+                if not self.ok: app.logger.warning(f'Read replica is {self.lag:.1f}s behind; reading from the primary')
+            except SQLAlchemyError as exc:
+                self.ok, self.lag = False, None
+                app.logger.warning(f'Read replica unavailable, reading from the primary: {exc}')
+            return self.ok
+
+    def measure_lag(self):
+        stamp = db.select(db.func.max(DataVersion.updated_at))
+        with db.engines['replica'].connect() as conn:
+            applied = conn.execute(stamp).scalar()
+        missing = db.select(db.func.min(DataVersion.updated_at))
+        if applied is not None: missing = missing.where(DataVersion.updated_at > applied)
+        with db.engines[None].connect() as conn:
+            oldest = conn.execute(missing).scalar()
+        return max(0.0, (datetime.utcnow() - oldest).total_seconds()) if oldest else 0.0
+
+    def fail(self):
+        with self.lock:
+            self.ok, self.checked_at = False, time.monotonic()
+
+replica_router = ReplicaRouter()
+
+class replica_reads:
+    """Route reads to the replica, as a `with` block or a view decorator."""
+    def __enter__(self):
+        self.previous = g.get('replica_reads', False)
+        self.routed = g.replica_reads = replica_router.healthy()
+        return self
+
+    def __exit__(self, *exc):
+        g.replica_reads = self.previous
+
+    def __call__(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            scope = self.__class__()
+            try:
+                with scope:
+                    return view(*args, **kwargs)
+            except DBAPIError as exc:
+                if not scope.routed: raise
+                # The replica failed mid-request: skip it for a while and answer from the primary
+                app.logger.warning(f'Read replica query failed in {view.__name__}, retrying on the primary: {exc}')
+                db.session.rollback()
+                replica_router.fail()
+                return view(*args, **kwargs)
+        return wrapper
+
+# --- Dashboard Stats ---
+STAT_NAMES = ('total_fleet', 'active_bookings', 'pending_kyc', 'revenue')
+BOOKING_STATUSES = ('Upcoming', 'Confirmed', 'Paid', 'Active', 'Completed', 'Cancelled')
+# Bookings that still count as active: not cancelled and the trip hasn't ended
+OPEN_BOOKING_STATUSES = ('Upcoming', 'Confirmed', 'Paid', 'Active')
+
+def bump_stat(name, delta):
+    if not delta: return
+    updated = db.session.execute(db.update(StatCounter).where(StatCounter.name == name).values(value=StatCounter.value + delta)).rowcount
+    if not updated: db.session.add(StatCounter(name=name, value=delta))
+
+def record_booking_stats(location, day, total, sign, count=1):
+    # Revenue side: sign is +1 when bookings start counting (created, un-cancelled) and -1 when they
+    # are cancelled; total is the summed total_cost of the `count` bookings booked that day there.
+    # active_bookings follows OPEN_BOOKING_STATUSES and is bumped by the callers.
+    total = int(total or 0)
+    bump_stat('revenue', sign * total)
+    updated = db.session.execute(db.update(DailyStat).where(DailyStat.day == day, DailyStat.location == location).values(
+        bookings=DailyStat.bookings + sign * count, revenue=DailyStat.revenue + sign * total)).rowcount
+    if not updated: db.session.add(DailyStat(day=day, location=location, bookings=sign * count, revenue=sign * total))
+
+def record_kyc_change(old_status, new_status):
+    if old_status == new_status: return
+    if new_status == 'Pending': bump_stat('pending_kyc', 1)
+    elif old_status == 'Pending': bump_stat('pending_kyc', -1)
+
+def reconcile_stats():
+    counters = {
+        'total_fleet': Car.query.count(),
+        'active_bookings': Booking.query.filter(Booking.status.in_(OPEN_BOOKING_STATUSES)).count(),
+        'pending_kyc': User.query.filter_by(kyc_status='Pending').count(),
+        'revenue': db.session.query(db.func.sum(Booking.total_cost)).filter(Booking.status != 'Cancelled').scalar() or 0,
+    }
+    StatCounter.query.delete()
+    db.session.add_all([StatCounter(name=name, value=value) for name, value in counters.items()])
+    DailyStat.query.delete()
+    day = db.func.date(Booking.date_booked)
+    rows = db.session.query(day, Car.location, db.func.count(Booking.id), db.func.sum(Booking.total_cost)).join(
+        Car, Booking.car_id == Car.id
+    ).filter(Booking.status != 'Cancelled', Booking.date_booked.isnot(None)).group_by(day, Car.location).all()
+    db.session.add_all([DailyStat(day=date.fromisoformat(d) if isinstance(d, str) else d, location=location or '',
+                                  bookings=count, revenue=revenue or 0) for d, location, count, revenue in rows])
+    db.session.commit()
+    return counters
+
+def dashboard_stats():
+    stats = dict.fromkeys(STAT_NAMES, 0)
+    stats.update({counter.name: counter.value for counter in StatCounter.query.all()})
+    return stats
+
+# --- Availability ---
+CAR_STAMP_LIMIT = 50  # Changes touching more cars than this just bump 'bookings' and force a full reload
+
+def car_stamp(car_id):
+    return f'bookings:{car_id}'
+
+def bump_booking_versions(car_ids):
+    # 'bookings' says something changed; the per-car stamps say which cars to reload
+    car_ids = set(car_ids)
+    if not car_ids: return
+    if len(car_ids) <= CAR_STAMP_LIMIT:
+        for car_id in car_ids: bump_version(car_stamp(car_id))
+    bump_version('bookings')
+
+class AvailabilityIndex:
+    # Per-car sorted booking intervals with a running max of end dates. Intervals starting
+    # before the requested end form a prefix found by bisect; the car is busy iff the
+    # largest end date in that prefix is after the requested start.
+    # When 'bookings' moves on, only cars whose own stamp changed are reloaded. A change with no
+    # car stamps (seed-data, reset-db, large bulk updates) or a new day reloads everything.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.horizon = None
+        self.car_stamps = {}
+        self.cars = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+
+    def _load(self, horizon, car_ids=None):
+        query = db.session.query(Booking.car_id, Booking.start_date, Booking.end_date).filter(
+            Booking.status != 'Cancelled',
+            Booking.start_date.isnot(None),
+            Booking.end_date > horizon
+        )
+        if car_ids is not None: query = query.filter(Booking.car_id.in_(car_ids))
+        cars = {}
+        for car_id, start, end in query.order_by(Booking.car_id, Booking.start_date):
+            starts, max_ends = cars.setdefault(car_id, ([], []))
+            starts.append(start)
+            max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+        return cars
+
+    def _sync(self):
+        version = get_version('bookings')
+        horizon = datetime.combine(datetime.utcnow().date(), datetime.min.time()) - timedelta(days=1)
+        with self.lock:
+            if self.version == version and self.horizon == horizon: return
+            # Stamps are read before the intervals, so a write landing in between is picked up next time
+            stamps = dict(db.session.query(DataVersion.name, DataVersion.version).filter(DataVersion.name.like('bookings:%')))
+            changed = [int(name.split(':', 1)[1]) for name, stamp in stamps.items() if self.car_stamps.get(name) != stamp]
+            if self.version is None or self.horizon != horizon or not changed:
+                cars = self._load(horizon)
+            else:
+                # Readers use self.cars without the lock, so swap in an updated copy
+                cars, fresh = dict(self.cars), self._load(horizon, changed)
+                for car_id in changed:
+                    if car_id in fresh: cars[car_id] = fresh[car_id]
+                    else: cars.pop(car_id, None)
+            self.cars, self.version, self.horizon, self.car_stamps = cars, version, horizon, stamps
+
+    def _overlaps(self, car_id, start, end):
+        starts, max_ends = self.cars.get(car_id, ((), ()))
+        i = bisect_left(starts, end)
+        return i > 0 and max_ends[i - 1] > start
+
+    def is_free(self, car_id, start, end):
+        self._sync()
+        # Only bookings ending after the horizon are held in memory
+        if start < self.horizon:
+            return not Booking.query.filter(
+                Booking.car_id == car_id,
+                Booking.status != 'Cancelled',
+                Booking.start_date < end,
+                Booking.end_date > start
+            ).first()
+        return not self._overlaps(car_id, start, end)
+
+    def busy_car_ids(self, start, end):
+        self._sync()
+        if start < self.horizon:
+            return {car_id for (car_id,) in db.session.query(Booking.car_id).filter(
+                Booking.status != 'Cancelled',
+                Booking.start_date < end,
+                Booking.end_date > start
+            ).distinct()}
+        return {car_id for car_id in self.cars if self._overlaps(car_id, start, end)}
+
+availability = AvailabilityIndex()
+
+# --- Reservation Holds ---
+class CouponUnavailable(Exception):
+    pass
+
+class SlotTaken(Exception):
+    pass
+
+def lock_car(car_id):
+    # A no-op UPDATE takes Postgres' row lock on this car and SQLite's write lock, so
+    # overlap checks that follow in the same transaction can't race another writer
+    return db.session.execute(db.update(Car).where(Car.id == car_id).values(is_available=Car.is_available)).rowcount
+
+def check_slot(car_id, start, end, user_id, now):
+    # Caller must hold lock_car(car_id). The user's own holds never block them.
+    if Booking.query.filter(
+        Booking.car_id == car_id,
+        Booking.status != 'Cancelled',
+        Booking.start_date < end,
+        Booking.end_date > start
+    ).first(): raise SlotTaken()
+    if BookingHold.query.filter(
+        BookingHold.car_id == car_id,
+        BookingHold.user_id != user_id,
+        BookingHold.expires_at > now,
+        BookingHold.start_date < end,
+        BookingHold.end_date > start
+    ).first(): raise SlotTaken()
+
+def place_hold(car_id, user_id, start, end):
+    now = datetime.utcnow()
+    if not lock_car(car_id): raise SlotTaken()
+    try:
+        check_slot(car_id, start, end, user_id, now)
+    except SlotTaken:
+        db.session.rollback()
+        raise
+    BookingHold.query.filter(BookingHold.car_id == car_id, BookingHold.expires_at <= now).delete(synchronize_session=False)
+    hold = BookingHold(user_id=user_id, car_id=car_id, start_date=start, end_date=end,
+                       expires_at=now + timedelta(minutes=app.config['HOLD_MINUTES']))
+    db.session.add(hold)
+    db.session.commit()
+    return hold
+
+def convert_hold(token, booking):
+    # Re-checks under the car lock, so an expired hold still converts if nobody took the slot
+    now = datetime.utcnow()
+    if booking_duration_error(booking.start_date, booking.end_date): raise ValueError('Booking dates are out of range')
+    if not lock_car(booking.car_id): raise SlotTaken()
+    try:
+        check_slot(booking.car_id, booking.start_date, booking.end_date, booking.user_id, now)
+    except SlotTaken:
+        db.session.rollback()
+        raise
+    if booking.coupon_code:
+        try:
+            redeem_coupon(booking.coupon_code, booking, now)
+        except CouponUnavailable:
+            db.session.rollback()
+            raise
+    if token:
+        BookingHold.query.filter_by(token=token, user_id=booking.user_id).delete(synchronize_session=False)
+    db.session.add(booking)
+    db.session.flush()
+    # Queued in the booking's own transaction, so a committed booking always gets its email
+    enqueue('booking_email', booking_id=booking.id)
+    if booking.status != 'Cancelled':
+        record_booking_stats(db.session.get(Car, booking.car_id).location or '', now.date(), booking.total_cost, 1)
+    if booking.status in OPEN_BOOKING_STATUSES: bump_stat('active_bookings', 1)
+    bump_booking_versions([booking.car_id])
+    db.session.commit()
+    return booking
+
+def redeem_coupon(code, booking, now):
+    # One conditional UPDATE takes a use only if the coupon is live and under its global cap. It also
+    # locks the coupon row until commit, so redemptions of one coupon are serialized and the per-user
+    # count below sees every earlier redemption.
+    rule = active_coupons.get().get(code)
+    if not rule: raise CouponUnavailable()
+    taken = db.session.execute(db.update(Coupon).where(
+        Coupon.id == rule['id'], Coupon.is_active == True,
+        db.or_(Coupon.max_redemptions.is_(None), Coupon.redemptions < Coupon.max_redemptions),
+        db.or_(Coupon.starts_at.is_(None), Coupon.starts_at <= now),
+        db.or_(Coupon.expires_at.is_(None), Coupon.expires_at > now),
+    ).values(redemptions=Coupon.redemptions + 1)).rowcount
+    if not taken: raise CouponUnavailable()
+    if rule['per_user_limit'] and CouponRedemption.query.filter_by(coupon_id=rule['id'], user_id=booking.user_id).count() >= rule['per_user_limit']:
+        raise CouponUnavailable()
+    db.session.add(CouponRedemption(coupon_id=rule['id'], user_id=booking.user_id, booking=booking, date_redeemed=now))
+
+def sweep_expired_holds():
+    removed = BookingHold.query.filter(BookingHold.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+# --- Booking Lifecycle ---
+LIFECYCLE_CHUNK = 500
+
+def sweep_booking_lifecycle(now=None, chunk_size=LIFECYCLE_CHUNK):
+    # Moves bookings along by date in short chunked transactions, so the booking table is never
+    # locked for long. The UPDATE repeats the filter, so rows an admin changed meanwhile are left alone.
+    # Availability ignores status (except Cancelled), so the 'bookings' version is not bumped.
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    transitions = (
+        ('Completed', (Booking.status.in_(OPEN_BOOKING_STATUSES), Booking.end_date <= now)),
+        ('Active', (Booking.status.in_(('Upcoming', 'Confirmed', 'Paid')), Booking.start_date <= now, Booking.end_date > now)),
+    )
+    counts = {}
+    for status, conditions in transitions:
+        counts[status] = 0
+        while True:
+            ids = [booking_id for (booking_id,) in db.session.query(Booking.id).filter(*conditions).order_by(Booking.id).limit(chunk_size)]
+            if not ids: break
+            updated = db.session.execute(db.update(Booking).where(Booking.id.in_(ids), *conditions).values(status=status)
+                                         .execution_options(synchronize_session=False)).rowcount
+            if status == 'Completed': bump_stat('active_bookings', -updated)
+            db.session.commit()
+            counts[status] += updated
+            if len(ids) < chunk_size: break
+    LifecycleRun.query.filter(LifecycleRun.ran_at < now - timedelta(days=30)).delete(synchronize_session=False)
+    db.session.add(LifecycleRun(ran_at=now, activated=counts['Active'], completed=counts['Completed'],
+                                seconds=round(time.perf_counter() - started, 3)))
+    db.session.commit()
+    return counts
+
+# --- Keyset Pagination ---
+PAGE_SIZE = 50
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(keys): return None
+        return [datetime.fromisoformat(v) if isinstance(key.type, db.DateTime) else v for key, v in zip(keys, values)]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_page(query, keys, cursor, descending=True, page_size=None):
+    # Seeks past the last row of the previous page instead of OFFSET, so every page costs the same
+    page_size = page_size or PAGE_SIZE
+    values = decode_cursor(cursor, keys) if cursor else None
+    if values:
+        clauses = []
+        for i, key in enumerate(keys):
+            step = key < values[i] if descending else key > values[i]
+            clauses.append(db.and_(*[keys[j] == values[j] for j in range(i)], step))
+        query = query.filter(db.or_(*clauses))
+    query = query.order_by(*[key.desc() if descending else key.asc() for key in keys])
+    rows = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor([getattr(rows[-1], key.key) for key in keys])
+    return rows, next_cursor
+
+# --- Fleet Facets ---
+def load_fleet_facets():
+    # One grouped scan of the listed (available) cars yields every filter option with its count
+    facets = {'location': {}, 'category': {}, 'fuel_type': {}, 'seats': {}}
+    rows = db.session.query(Car.location, Car.category, Car.fuel_type, Car.seats, db.func.count(Car.id)).filter(
+        Car.is_available == True
+    ).group_by(
+        Car.location, Car.category, Car.fuel_type, Car.seats
+    ).all()
+    for location, category, fuel_type, seats, count in rows:
+        for name, value in (('location', location), ('category', category), ('fuel_type', fuel_type), ('seats', seats)):
+            if value is None: continue
+            facets[name][value] = facets[name].get(value, 0) + count
+    return {name: dict(sorted(counts.items())) for name, counts in facets.items()}
+
+fleet_facets = VersionedCache('cars', load_fleet_facets)
+
+# --- Bulk Admin Operations ---
+CAR_TRANSMISSIONS = ('Auto', 'Manual')
+CAR_FUEL_TYPES = ('Petrol', 'Diesel', 'Electric', 'CNG', 'Hybrid')
+IMPORT_BATCH_SIZE = 500
+BULK_ERROR_LIMIT = 100  # per-row errors returned to the client; the failed count is always exact
+BULK_STATUS_LIMIT = 1000
+
+def validate_car_row(row):
+    # Returns (values, None) or (None, error); shared by the add-car form and the importer
+    if not isinstance(row, dict): return None, 'expected an object with car fields'
+    row = {str(k).strip().lower(): v.strip() if isinstance(v, str) else v for k, v in row.items() if k}
+    values = {}
+    for field, limit in (('name', 100), ('category', 50), ('image_url', 500), ('location', 50)):
+        value = row.get(field)
+        if not value or not isinstance(value, str): return None, f'{field} is required'
+        if len(value) > limit: return None, f'{field} is longer than {limit} characters'
+        values[field] = value
+    for field, allowed in (('transmission', CAR_TRANSMISSIONS), ('fuel_type', CAR_FUEL_TYPES)):
+        values[field] = row.get(field) or allowed[0]
+        if values[field] not in allowed: return None, f"{field} must be one of {', '.join(allowed)}"
+    try:
+        values['price_per_hr'] = int(row.get('price_per_hr'))
+        values['seats'] = int(row.get('seats') or 5)
+    except (TypeError, ValueError):
+        return None, 'price_per_hr and seats must be whole numbers'
+    if values['price_per_hr'] <= 0: return None, 'price_per_hr must be positive'
+    if not 2 <= values['seats'] <= 12: return None, 'seats must be between 2 and 12'
+    values['is_available'] = str(row.get('is_available', True)).lower() not in ('0', 'false', 'no')
+    return values, None
+
+def read_import_rows(stream, filename):
+    # Yields (line number, row) straight off the upload, so large files never sit in memory whole
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if filename.lower().endswith(('.jsonl', '.ndjson')):
+        for line_no, line in enumerate(text, 1):
+            if not line.strip(): continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError:
+                yield line_no, None
+    else:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+
+def import_cars(rows):
+    imported, failed, errors, batch = 0, 0, [], []
+
+    def flush():
+        nonlocal imported
+        db.session.execute(db.insert(Car), batch)
+        bump_stat('total_fleet', len(batch))
+        bump_version('cars')
+        db.session.commit()
+        imported += len(batch)
+        batch.clear()
+
+    for line_no, row in rows:
+        values, error = validate_car_row(row)
+        if error:
+            failed += 1
+            if len(errors) < BULK_ERROR_LIMIT: errors.append({'line': line_no, 'error': error})
+            continue
+        batch.append(values)
+        if len(batch) >= IMPORT_BATCH_SIZE: flush()
+    if batch: flush()
+    return {'imported': imported, 'failed': failed, 'errors': errors}
+
+def bulk_update_booking_status(updates):
+    # updates: {booking_id: new_status}. One SELECT for validation and stats, one UPDATE for all rows.
+    errors = [{'id': booking_id, 'error': f'unknown status {status!r}'} for booking_id, status in updates.items() if status not in BOOKING_STATUSES]
+    wanted = {booking_id: status for booking_id, status in updates.items() if status in BOOKING_STATUSES}
+    rows = db.session.query(Booking.id, Booking.car_id, Booking.status, Booking.total_cost, Booking.date_booked, Car.location).outerjoin(
+        Car, Car.id == Booking.car_id).filter(Booking.id.in_(wanted)).all() if wanted else []
+    found = {row.id for row in rows}
+    errors += [{'id': booking_id, 'error': 'booking not found'} for booking_id in wanted if booking_id not in found]
+    changes = {row.id: wanted[row.id] for row in rows if row.status != wanted[row.id]}
+    if changes:
+        # Cancelling or restoring a booking moves it in or out of the dashboard totals
+        deltas = {}
+        for row in rows:
+            if row.id not in changes or not row.date_booked: continue
+            sign = int(changes[row.id] != 'Cancelled') - int(row.status != 'Cancelled')
+            if not sign: continue
+            count, total = deltas.get((row.location or '', row.date_booked.date(), sign), (0, 0))
+            deltas[(row.location or '', row.date_booked.date(), sign)] = (count + 1, total + (row.total_cost or 0))
+        for (location, day, sign), (count, total) in deltas.items():
+            record_booking_stats(location, day, total, sign, count)
+        bump_stat('active_bookings', sum(int(changes[row.id] in OPEN_BOOKING_STATUSES) - int(row.status in OPEN_BOOKING_STATUSES)
+                                         for row in rows if row.id in changes))
+        db.session.execute(db.update(Booking).where(Booking.id.in_(changes)).values(
+            status=db.case(changes, value=Booking.id)).execution_options(synchronize_session=False))
+        # Only cancelling or restoring a booking changes when its car is free
+        bump_booking_versions(row.car_id for row in rows if row.id in changes and (changes[row.id] == 'Cancelled') != (row.status == 'Cancelled'))
+        db.session.commit()
+    return {'updated': len(changes), 'failed': len(errors), 'errors': errors[:BULK_ERROR_LIMIT]}
+
+# --- Pricing ---
+TAX = 648
+DRIVER_FEE = 500
+DELIVERY_FEE = 500
+MIN_BILLABLE_HOURS = 24
+
+def billable_hours(start, end):
+    return max(MIN_BILLABLE_HOURS, math.ceil((end - start).total_seconds() / 3600))
+
+def price_breakdown(price_per_hr, hours, with_driver, with_delivery, discount):
+    base_cost = hours * price_per_hr
+    driver_fee = DRIVER_FEE if with_driver else 0
+    # Delivery is included with a chauffeur and charged for self-drive
+    delivery_fee = DELIVERY_FEE if with_delivery and not with_driver else 0
+    subtotal = base_cost + driver_fee + delivery_fee + TAX
+    discount = min(discount, subtotal)
+    return {'base_cost': base_cost, 'driver_fee': driver_fee, 'delivery_fee': delivery_fee,
+            'tax': TAX, 'discount': discount, 'total': subtotal - discount}
+
+def load_car_prices():
+    return dict(db.session.query(Car.id, Car.price_per_hr).all())
+
+def load_active_coupons():
+    return {coupon.code: {'id': coupon.id, 'discount': coupon.discount_amount, 'starts_at': coupon.starts_at,
+                          'expires_at': coupon.expires_at, 'per_user_limit': coupon.per_user_limit}
+            for coupon in Coupon.query.filter_by(is_active=True).all()}
+
+def coupon_discount(coupons, code, now):
+    # Discount the cached rule grants at `now`; caps are only checked when the booking is confirmed
+    rule = coupons.get(code)
+    if not rule or (rule['starts_at'] and rule['starts_at'] > now) or (rule['expires_at'] and rule['expires_at'] <= now): return 0
+    return rule['discount']
+
+car_prices = VersionedCache('cars', load_car_prices)
+active_coupons = VersionedCache('coupons', load_active_coupons)
+
+class PricingEngine:
+    # Quotes are memoized by (car, price version, range, options, coupon, discount); a price edit
+    # bumps its version and a coupon edit or expiry changes the discount, so stale entries stop being hit
+    def __init__(self, size=4096):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = size
+
+    def quote_many(self, car_ids, start, end, with_driver=False, with_delivery=False, coupon_code=''):
+        prices, price_version = car_prices.get_with_version()
+        discount = coupon_discount(active_coupons.get(), coupon_code, datetime.utcnow()) if coupon_code else 0
+        coupon_code = coupon_code if discount else ''
+        hours = billable_hours(start, end)
+        quotes = {}
+        for car_id in car_ids:
+            if car_id not in prices: continue
+            key = (car_id, price_version, start, end, with_driver, with_delivery, coupon_code, discount)
+            with self.lock:
+                quote = self.entries.get(key)
+                if quote is not None: self.entries.move_to_end(key)
+            if quote is None:
+                quote = price_breakdown(prices[car_id], hours, with_driver, with_delivery, discount)
+                quote.update(car_id=car_id, hours=hours, coupon=coupon_code)
+                with self.lock:
+                    self.entries[key] = quote
+                    if len(self.entries) > self.size: self.entries.popitem(last=False)
+            quotes[car_id] = dict(quote)
+        return quotes
+
+    def quote(self, car_id, start, end, with_driver=False, with_delivery=False, coupon_code=''):
+        return self.quote_many([car_id], start, end, with_driver, with_delivery, coupon_code).get(car_id)
+
+pricing = PricingEngine()
+quote_signer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='booking-quote')
+
+def sign_quote(quote, user_id, start, end, with_delivery, delivery_address):
+    return quote_signer.dumps(dict(quote, user_id=user_id, start=start.isoformat(), end=end.isoformat(),
+                                   with_delivery=with_delivery, delivery_address=delivery_address))
+
+def load_quote(token, user_id, car_id):
+    try:
+        quote = quote_signer.loads(token or '', max_age=app.config['QUOTE_MINUTES'] * 60)
+    except BadSignature:
+        return None
+    if quote['user_id'] != user_id or quote['car_id'] != car_id: return None
+    quote['start'], quote['end'] = datetime.fromisoformat(quote['start']), datetime.fromisoformat(quote['end'])
+    if booking_duration_error(quote['start'], quote['end']): return None
+    return quote
+
+MIN_BOOKING_DAYS, MAX_BOOKING_DAYS = 1, 30
+
+def booking_duration_error(start, end):
+    days = (end - start).days
+    if days < MIN_BOOKING_DAYS: return f"❌ Minimum booking duration is 24 hours ({MIN_BOOKING_DAYS} Day)."
+    if days > MAX_BOOKING_DAYS: return f"❌ Maximum booking duration is {MAX_BOOKING_DAYS} Days."
+    return None
+
+# Raster formats only: the bytes are served from our own origin, so nothing scriptable like SVG
+KYC_IMAGE_TYPES = {
+    'image/jpeg': lambda raw: raw.startswith(b'\xff\xd8\xff'),
+    'image/png': lambda raw: raw.startswith(b'\x89PNG\r\n\x1a\n'),
+    'image/webp': lambda raw: raw[:4] == b'RIFF' and raw[8:12] == b'WEBP',
+}
+
+def store_kyc_image(data_url):
+    # Accepts the 'data:image/...;base64,...' string posted by kyc.html and returns its digest
+    if not data_url or not data_url.startswith('data:') or ',' not in data_url: return None
+    header, encoded = data_url[5:].split(',', 1)
+    mime_type = header.split(';')[0].lower()
+    if mime_type not in KYC_IMAGE_TYPES or not header.endswith(';base64'): return None
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if not raw or not KYC_IMAGE_TYPES[mime_type](raw): return None
+    digest = hashlib.sha256(raw).hexdigest()
+    if not db.session.get(KycImage, digest):
+        db.session.add(KycImage(digest=digest, mime_type=mime_type, size=len(raw), data=raw))
+    return digest
+
+# --- Password Hashing ---
+HASH_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class HashingBusy(Exception):
+    pass
+
+class HostSlots:
+    # Numbered lock files; an flock()ed file is a taken slot. Every worker process on the host
+    # sees the same files, and the kernel frees a dead worker's slots.
+    def __init__(self, name):
+        self.name = name
+        self.fallback = {}
+
+    def try_acquire(self, count):
+        if not count: return None
+        if fcntl is None:
+            semaphore = self.fallback.setdefault(count, threading.BoundedSemaphore(count))
+            return semaphore if semaphore.acquire(blocking=False) else None
+        os.makedirs(app.config['HASH_SLOT_DIR'], exist_ok=True)
+        first = random.randrange(count)
+        for i in range(count):
+            handle = open(os.path.join(app.config['HASH_SLOT_DIR'], f'{self.name}-{(first + i) % count}.lock'), 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except BlockingIOError:
+                handle.close()
+        return None
+
+    def release(self, handle):
+        if fcntl is None: return handle.release()
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+class PasswordHasher:
+    # Hashes run in the request's own process, but at most HASH_WORKERS at once on the host. At most
+    # HASH_QUEUE_LIMIT may be running or waiting, and none waits longer than HASH_WAIT_SECONDS;
+    # beyond that sign-ins are turned away instead of tying up the worker.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tickets = HostSlots('queue')
+        self.slots = HostSlots('run')
+        self.in_flight = 0
+        self.stats = {'count': 0, 'seconds': 0.0, 'rejected': 0, 'rehashed': 0, 'max_in_flight': 0,
+                      'buckets': [0] * (len(HASH_LATENCY_BUCKETS) + 1)}
+
+    def _reject(self):
+        with self.lock:
+            self.stats['rejected'] += 1
+        request_metrics.count('password_hash_rejected_total')
+        raise HashingBusy()
+
+    def _run(self, fn, *args):
+        ticket = self.tickets.try_acquire(app.config['HASH_QUEUE_LIMIT'])
+        if not ticket: self._reject()
+        with self.lock:
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+        started = time.perf_counter()
+        hashed = False
+        try:
+            if app.config['HASH_WORKERS']:
+                deadline = time.monotonic() + app.config['HASH_WAIT_SECONDS']
+                while not (slot := self.slots.try_acquire(app.config['HASH_WORKERS'])):
+                    if time.monotonic() >= deadline: self._reject()
+                    time.sleep(0.005)
+            else:
+                slot = None
+            try:
+                hashed = True
+                return fn(*args)
+            finally:
+                if slot: self.slots.release(slot)
+        finally:
+            self.tickets.release(ticket)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.in_flight -= 1
+                if hashed:
+                    self.stats['count'] += 1
+                    self.stats['seconds'] += elapsed
+                    self.stats['buckets'][bisect_left(HASH_LATENCY_BUCKETS, elapsed)] += 1
+            if hashed: request_metrics.observe(request.endpoint if has_request_context() else 'cli', {'password_hash_seconds': elapsed})
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def rehash(self, password):
+        pwhash = self.hash(password)
+        with self.lock:
+            self.stats['rehashed'] += 1
+        return pwhash
+
+    def needs_rehash(self, pwhash):
+        return not pwhash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, buckets=list(self.stats['buckets']), in_flight=self.in_flight)
+
+hasher = PasswordHasher()
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    # login, register and security each render a template named after the endpoint
+    flash('⏳ We are handling a lot of sign-ins right now. Please try again in a moment.')
+    response = make_response(render_template(f'{request.endpoint}.html'), 503)
+    response.headers['Retry-After'] = '2'
+    return response
+
+# --- Request Metrics ---
+METRIC_BUCKETS = {
+    'request_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    'sql_queries': (1, 2, 5, 10, 20, 50, 100),
+    'sql_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+    'template_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+    'response_bytes': (1024, 10240, 102400, 1048576, 10485760),
+    'password_hash_seconds': HASH_LATENCY_BUCKETS,
+}
+METRIC_HELP = {
+    'request_seconds': 'Wall time per request',
+    'sql_queries': 'SQL statements per request',
+    'sql_seconds': 'Time spent in SQL per request',
+    'template_seconds': 'Time spent rendering templates per request',
+    'response_bytes': 'Response body size',
+    'password_hash_seconds': 'Password hash and verify latency, including the wait for a hashing slot',
+}
+METRIC_COUNTERS = {
+    'password_hash_rejected_total': 'Sign-ins turned away because password hashing was saturated',
+}
+
+class RequestMetrics:
+    # Histograms per endpoint kept as {metric: {endpoint: [bucket counts..., +Inf, sum]}},
+    # plain counters under 'counters'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {name: {} for name in METRIC_BUCKETS}
+        self.counters = dict.fromkeys(METRIC_COUNTERS, 0)
+        self.last_dump = 0.0
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, endpoint, values):
+        with self.lock:
+            for name, value in values.items():
+                buckets = METRIC_BUCKETS[name]
+                row = self.data[name].get(endpoint)
+                if row is None: row = self.data[name][endpoint] = [0] * (len(buckets) + 1) + [0.0]
+                row[bisect_left(buckets, value)] += 1
+                row[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {name: {endpoint: list(row) for endpoint, row in rows.items()} for name, rows in self.data.items()}
+            snapshot['counters'] = dict(self.counters)
+            return snapshot
+
+    def dump(self, directory, force=False):
+        # Rate-limited so the file write stays off the per-request cost
+        now = time.monotonic()
+        if not force and now - self.last_dump < 10: return
+        self.last_dump = now
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        directory = app.config['METRICS_DIR']
+        if not directory: return self.snapshot()
+        self.dump(directory, force=True)
+        merged = {name: {} for name in METRIC_BUCKETS}
+        merged['counters'] = dict.fromkeys(METRIC_COUNTERS, 0)
+        for filename in os.listdir(directory):
+            if not filename.startswith('metrics-') or not filename.endswith('.json'): continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, value in snapshot.pop('counters', {}).items():
+                if name in merged['counters']: merged['counters'][name] += value
+            for name, rows in snapshot.items():
+                if name not in merged: continue
+                for endpoint, row in rows.items():
+                    total = merged[name].setdefault(endpoint, [0] * len(row))
+                    merged[name][endpoint] = [a + b for a, b in zip(total, row)]
+        return merged
+
+request_metrics = RequestMetrics()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['sql_started'].pop()
+    if not has_request_context() or 'request_started' not in g: return
+    g.sql_queries += 1
+    g.sql_seconds += elapsed
+    if g.slow_log is not None: g.slow_log.append((elapsed, statement))
+
+@before_render_template.connect_via(app)
+def template_started(sender, template, context, **extra):
+    if 'request_started' in g: g.template_started.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def template_finished(sender, template, context, **extra):
+    # Fragments rendered inside a page (car_card) are part of the outer render, so only the
+    # outermost template adds its time
+    if 'request_started' in g and g.template_started:
+        started = g.template_started.pop()
+        if not g.template_started: g.template_seconds += time.perf_counter() - started
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.template_seconds = 0.0
+    g.template_started = []
+    g.slow_log = [] if app.config['SLOW_REQUEST_MS'] else None
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g: return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe(endpoint, {
+        'request_seconds': elapsed,
+        'sql_queries': g.sql_queries,
+        'sql_seconds': g.sql_seconds,
+        'template_seconds': g.template_seconds,
+        # Streamed responses have no length up front and are counted as 0
+        'response_bytes': response.calculate_content_length() or 0,
+    })
+    if app.config['METRICS_DIR']: request_metrics.dump(app.config['METRICS_DIR'])
+    if g.slow_log is not None and elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        statements = '\n'.join(f'  {seconds * 1000:.1f}ms {statement}' for seconds, statement in sorted(g.slow_log, reverse=True)[:10])
+        app.logger.warning(f'Slow request {request.method} {request.path} ({endpoint}) took {elapsed * 1000:.0f}ms '
+                           f'with {g.sql_queries} queries ({g.sql_seconds * 1000:.0f}ms SQL)\n{statements}')
+    return response
+
+def render_prometheus(snapshot):
+    lines = []
+    counters = snapshot.pop('counters', {})
+    for name, rows in snapshot.items():
+        buckets = METRIC_BUCKETS[name]
+        lines.append(f'# HELP drivex_{name} {METRIC_HELP[name]}')
+        lines.append(f'# TYPE drivex_{name} histogram')
+        for endpoint, row in sorted(rows.items()):
+            cumulative = 0
+            for bound, count in zip([str(b) for b in buckets] + ['+Inf'], row[:-1]):
+                cumulative += count
+                lines.append(f'drivex_{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'drivex_{name}_sum{{endpoint="{endpoint}"}} {row[-1]}')
+            lines.append(f'drivex_{name}_count{{endpoint="{endpoint}"}} {cumulative}')
+    for name, value in sorted(counters.items()):
+        lines.append(f'# HELP drivex_{name} {METRIC_COUNTERS[name]}')
+        lines.append(f'# TYPE drivex_{name} counter')
+        lines.append(f'drivex_{name} {value}')
+    # A gauge of the worker answering this scrape, so it carries its pid
+    lines.append('# TYPE drivex_password_hash_in_flight gauge')
+    lines.append(f"drivex_password_hash_in_flight{{pid=\"{os.getpid()}\"}} {hasher.snapshot()['in_flight']}")
+    if replica_router.configured():
+        lines.append('# TYPE drivex_replica_healthy gauge')
+        lines.append(f'drivex_replica_healthy {int(replica_router.healthy())}')
+        if replica_router.lag is not None:
+            lines.append('# TYPE drivex_replica_lag_seconds gauge')
+            lines.append(f'drivex_replica_lag_seconds {replica_router.lag:.3f}')
+    return '\n'.join(lines) + '\n'
+
+# --- Login Session ---
+# Every authenticated request loads the (small, blob-free) User row by primary key, so a login on
+# another device ends this session on every worker at once. Static files skip the lookup.
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 @app.before_request
 def check_session_token():
+    if request.endpoint == 'static': return
     if current_user.is_authenticated:
         if current_user.session_token != session.get('token'):
             logout_user()
@@ -112,20 +1224,484 @@ def check_session_token():
 
 @app.route('/chatbot', methods=['POST'])
 def chatbot():
-    data = request.json
-    msg = data.get('message', '').lower()
-    response = "I didn't understand that. You can ask about car prices, documents, or how to book."
-    if 'hello' in msg or 'hi' in msg: response = "Hello! Welcome to DriveX. How can I assist you today?"
-    elif 'price' in msg or 'cost' in msg: response = "Our cars start from ₹75/hr. Check the 'Cars' page for details."
-    elif 'book' in msg: response = "To book, go to the 'Cars' page, select a vehicle, and proceed to payment."
-    elif 'document' in msg or 'id' in msg: response = "You need a valid Driving License and Aadhaar Card."
-    elif 'contact' in msg: response = "Email us at support@drivex.com."
-    return jsonify({'response': response})
+    data = request.get_json(silent=True) or {}
+    return jsonify(chatbot_engine.answer(str(data.get('message', ''))))
+
+@app.route('/chatbot/batch', methods=['POST'])
+def chatbot_batch():
+    messages = (request.get_json(silent=True) or {}).get('messages')
+    if not isinstance(messages, list) or len(messages) > CHAT_BATCH_LIMIT:
+        return jsonify({'error': f'send "messages" as a list of at most {CHAT_BATCH_LIMIT} strings'}), 400
+    return jsonify({'responses': [chatbot_engine.answer(str(message)) for message in messages]})
+
+# --- Response Cache ---
+class LRUBackend:
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        with self.lock:
+            if key in self.entries: self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self.entries:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+class SQLiteBackend:
+    # A cache file every worker on the host can read, so one render serves them all
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self._conn().execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+
+    def _conn(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.conn.execute('PRAGMA journal_mode=WAL')
+        return self.local.conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, size):
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, size, used) VALUES (?, ?, ?, ?)',
+                     (key, pickle.dumps(value), size, time.time()))
+        if random.random() < 0.05:
+            # Evict oldest entries until the store is back under its byte budget
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC) AS running FROM cache) WHERE running > ?)',
+                         (self.max_bytes,))
+
+def make_cache_backend(setting, max_bytes):
+    if setting == 'off': return None
+    if setting.startswith('sqlite:'): return SQLiteBackend(setting[len('sqlite:'):], max_bytes)
+    return LRUBackend(max_bytes)
+
+response_cache = make_cache_backend(app.config['RESPONSE_CACHE'], app.config['RESPONSE_CACHE_BYTES'])
+fragment_cache = LRUBackend(4 * 1024 * 1024)
+# Same for every worker of a deploy, different after any template edit
+TEMPLATE_STAMP = hashlib.sha1(''.join(
+    f'{path}:{os.path.getmtime(path)}' for path in sorted(glob.glob(os.path.join(app.root_path, 'templates', '*.html')))
+).encode()).hexdigest()[:12]
+
+def cached_page(*version_names):
+    # Whole-page cache for anonymous GETs. Signed-in pages and pages carrying flash messages
+    # differ per visitor, so they always render (their car cards still come from fragments).
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if response_cache is None or current_user.is_authenticated or session.get('_flashes'):
+                return view(*args, **kwargs)
+            params = sorted((k, v) for k, v in request.args.items(multi=True) if v and v != 'All')
+            names = version_names + (('bookings',) if request.args.get('start_date') else ())
+            key = f"page:{TEMPLATE_STAMP}:{request.endpoint}:{urlencode(params)}:{'|'.join(get_version(n) for n in names)}"
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough: return response
+                entry = (response.get_data(), response.mimetype, datetime.utcnow().replace(microsecond=0))
+                response_cache.set(key, entry, len(entry[0]))
+            response = make_response(entry[0])
+            response.mimetype = entry[1]
+            response.last_modified = entry[2]
+            response.set_etag(hashlib.sha1(key.encode()).hexdigest())
+            response.headers['Cache-Control'] = 'public, no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+@app.template_global()
+def car_card(car, quote=None):
+    if 'card_versions' not in g: g.card_versions = get_version('cars') + get_version('reviews')
+    key = (TEMPLATE_STAMP, car.id, g.card_versions, quote['total'] if quote else None)
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render_template('_car_card.html', car=car, quote=quote))
+        fragment_cache.set(key, html, len(html))
+    return html
+
+# --- Fleet Analytics ---
+# Utilization over a window of whole days: booked vs available hours per car, revenue prorated to
+# the part of each booking inside the window, and each car's longest idle streak. Bookings are read
+# in one columnar query as epoch hours; the interval arithmetic is vectorized when NumPy is installed.
+ANALYTICS_MAX_DAYS = 366
+analytics_cache = LRUBackend(8 * 1024 * 1024)
+
+def epoch_hours(column):
+    # julianday() is much cheaper than SQLite's strftime('%s') that extract('epoch') compiles to
+    if db.engine.dialect.name == 'sqlite': return (db.func.julianday(column) - 2440587.5) * 24.0
+    return db.cast(db.extract('epoch', column), db.Float) / 3600.0
+
+def to_epoch_hours(moment):
+    return (moment - datetime(1970, 1, 1)).total_seconds() / 3600.0
+
+def interval_stats_numpy(car_ids, rows, window_start, window_end):
+    n = len(car_ids)
+    booked, revenue, count = np.zeros(n), np.zeros(n), np.zeros(n, dtype=np.int64)
+    idle = np.full(n, window_end - window_start)
+    data = np.fromiter(chain.from_iterable(rows), dtype=float, count=4 * len(rows)).reshape(-1, 4)
+    ids = np.array(car_ids, dtype=float)
+    index = np.searchsorted(ids, data[:, 0])
+    known = index < n
+    known[known] = ids[index[known]] == data[known, 0]
+    data, index = data[known], index[known]
+    if len(index):
+        order = np.lexsort((data[:, 1], index))
+        data, index = data[order], index[order]
+        start, end = np.clip(data[:, 1], window_start, window_end), np.clip(data[:, 2], window_start, window_end)
+        overlap = end - start
+        booked = np.bincount(index, overlap, minlength=n)
+        revenue = np.bincount(index, data[:, 3] * overlap / np.maximum(data[:, 2] - data[:, 1], 1e-9), minlength=n)
+        count = np.bincount(index, minlength=n)
+        # Gap before each booking (from the window start for a car's first one), then after its last
+        first = np.r_[True, index[1:] != index[:-1]]
+        last = np.r_[index[1:] != index[:-1], True]
+        gaps = np.maximum(start - np.where(first, window_start, np.r_[window_start, end[:-1]]), 0)
+        longest = np.zeros(n)
+        np.maximum.at(longest, index, gaps)
+        np.maximum.at(longest, index[last], window_end - end[last])
+        idle = np.where(count > 0, longest, idle)
+    return booked.tolist(), revenue.tolist(), count.tolist(), idle.tolist()
+
+def interval_stats_python(car_ids, rows, window_start, window_end):
+    position = {car_id: i for i, car_id in enumerate(car_ids)}
+    n = len(car_ids)
+    booked, revenue, count, idle = [0.0] * n, [0.0] * n, [0] * n, [window_end - window_start] * n
+    last_end, longest = {}, {}
+    for car_id, start, end, total in sorted(r for r in rows if r[0] in position):
+        i = position[car_id]
+        clipped_start, clipped_end = min(max(start, window_start), window_end), min(max(end, window_start), window_end)
+        overlap = clipped_end - clipped_start
+        booked[i] += overlap
+        revenue[i] += total * overlap / max(end - start, 1e-9)
+        count[i] += 1
+        longest[i] = max(longest.get(i, 0), clipped_start - last_end.get(i, window_start))
+        last_end[i] = clipped_end
+    for i, end in last_end.items():
+        idle[i] = max(longest[i], window_end - end)
+    return booked, revenue, count, idle
+
+def fleet_utilization(first_day, last_day):
+    window_start = datetime.combine(first_day, datetime.min.time())
+    window_end = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+    cars = db.session.query(Car.id, Car.name, Car.location, Car.category).order_by(Car.id).all()
+    # Every column is a plain number, so the driver's tuples are read straight off the cursor; wrapping
+    # each one in a Row costs about a third of the fetch on a year of bookings
+    result = db.session.connection().execute(db.select(
+        Booking.car_id, epoch_hours(Booking.start_date), epoch_hours(Booking.end_date), db.func.coalesce(Booking.total_cost, 0)
+    ).where(
+        Booking.status != 'Cancelled', Booking.car_id.isnot(None),
+        Booking.start_date < window_end, Booking.end_date > window_start,
+    ))
+    rows = result.cursor.fetchall()
+    result.close()
+    hours, days = (window_end - window_start).total_seconds() / 3600.0, (last_day - first_day).days + 1
+    compute = interval_stats_numpy if np is not None else interval_stats_python
+    booked, revenue, count, idle = compute([car.id for car in cars], rows, to_epoch_hours(window_start), to_epoch_hours(window_end))
+
+    per_car = [{
+        'car_id': car.id, 'name': car.name, 'location': car.location or '', 'category': car.category or '',
+        'bookings': count[i], 'booked_hours': round(booked[i], 1), 'available_hours': hours,
+        'utilization': round(booked[i] / hours, 4), 'revenue': round(revenue[i]),
+        'revenue_per_car_day': round(revenue[i] / days, 2), 'longest_idle_hours': round(idle[i], 1),
+    } for i, car in enumerate(cars)]
+
+    def rollup(field):
+        groups = {}
+        for row in per_car:
+            label = row[field] if field else 'All cars'
+            group = groups.setdefault(label, {'name': label, 'cars': 0, 'bookings': 0, 'booked_hours': 0.0, 'revenue': 0, 'longest_idle_hours': 0.0})
+            group['cars'] += 1
+            group['bookings'] += row['bookings']
+            group['booked_hours'] += row['booked_hours']
+            group['revenue'] += row['revenue']
+            group['longest_idle_hours'] = max(group['longest_idle_hours'], row['longest_idle_hours'])
+        for group in groups.values():
+            group['booked_hours'] = round(group['booked_hours'], 1)
+            group['available_hours'] = group['cars'] * hours
+            group['utilization'] = round(group['booked_hours'] / group['available_hours'], 4)
+            group['revenue_per_car_day'] = round(group['revenue'] / (group['cars'] * days), 2)
+        return sorted(groups.values(), key=lambda group: -group['utilization'])
+
+    return {
+        'start': first_day.isoformat(), 'end': last_day.isoformat(), 'days': days, 'bookings': len(rows),
+        'totals': (rollup(None) or [None])[0], 'by_location': rollup('location'), 'by_category': rollup('category'),
+        'cars': sorted(per_car, key=lambda row: -row['utilization']),
+    }
+
+def cached_fleet_utilization(first_day, last_day):
+    key = ('utilization', first_day, last_day, get_version('bookings'), get_version('cars'))
+    report = analytics_cache.get(key)
+    if report is None:
+        report = fleet_utilization(first_day, last_day)
+        analytics_cache.set(key, report, 200 * len(report['cars']) + 1000)
+    return report
+
+# --- Background Jobs ---
+# Work that shouldn't hold up a request (SMTP round trips, image processing) is written to the
+# Job table in the caller's transaction and picked up by `flask worker`.
+JOB_HANDLERS = {}
+
+class JobSkipped(Exception):
+    # Raised by a handler that cannot do its work and should not be retried
+    pass
+
+def job_handler(kind):
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+def enqueue(kind, **payload):
+    db.session.add(Job(kind=kind, payload=json.dumps(payload)))
+
+def job_backoff(attempts):
+    delay = min(app.config['JOB_BACKOFF_SECONDS'] * 2 ** (attempts - 1), 3600)
+    return delay * random.uniform(1.0, 1.1)
+
+def claim_job(worker_id):
+    now = datetime.utcnow()
+    # Running jobs whose worker died are handed out again once they time out
+    claimable = db.or_(
+        db.and_(Job.status == 'Queued', Job.run_at <= now),
+        db.and_(Job.status == 'Running', Job.locked_at < now - timedelta(seconds=app.config['JOB_TIMEOUT_SECONDS'])),
+    )
+    for (job_id,) in db.session.query(Job.id).filter(claimable).order_by(Job.run_at).limit(5).all():
+        # The conditional UPDATE is the lock: only one worker sees a rowcount of 1
+        claimed = Job.query.filter(Job.id == job_id, claimable).update(
+            {'status': 'Running', 'locked_by': worker_id, 'locked_at': now, 'attempts': Job.attempts + 1},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed: return db.session.get(Job, job_id)
+    return None
+
+def run_job(job):
+    job_id, kind, attempts = job.id, job.kind, job.attempts
+    try:
+        with app.test_request_context():
+            JOB_HANDLERS[kind](**json.loads(job.payload))
+    except JobSkipped as exc:
+        # Retrying won't help, but the job did not do its work either
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = 'Skipped'
+        job.last_error = str(exc)[:2000]
+        app.logger.warning(f'Job {job_id} ({kind}) skipped: {job.last_error}')
+    except Exception as exc:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = f'{type(exc).__name__}: {exc}'[:2000]
+        if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            job.status = 'Failed'
+        else:
+            job.status = 'Queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=job_backoff(attempts))
+        app.logger.warning(f'Job {job_id} ({kind}) failed on attempt {attempts}: {job.last_error}')
+    else:
+        job = db.session.get(Job, job_id)
+        job.status = 'Done'
+        job.last_error = None
+    db.session.commit()
+    return job.status
+
+def work_jobs(worker_id, once=False, poll=2.0):
+    processed, last_sweep = 0, None
+    while True:
+        job = claim_job(worker_id)
+        if job:
+            run_job(job)
+            processed += 1
+            continue
+        if once: return processed
+        interval = app.config['LIFECYCLE_SWEEP_SECONDS']
+        if interval and (last_sweep is None or time.monotonic() - last_sweep >= interval):
+            counts = sweep_booking_lifecycle()
+            if any(counts.values()): app.logger.info(f"Lifecycle sweep: {counts['Active']} active, {counts['Completed']} completed")
+            last_sweep = time.monotonic()
+        Job.query.filter(Job.status == 'Done', Job.locked_at < datetime.utcnow() - timedelta(days=7)).delete(synchronize_session=False)
+        db.session.commit()
+        time.sleep(poll)
+
+@job_handler('kyc_thumbnail')
+def make_kyc_thumbnail(digest):
+    if Image is None: raise JobSkipped('Pillow is not installed')
+    image = KycImage.query.options(db.undefer(KycImage.data), db.undefer(KycImage.thumbnail)).get(digest)
+    if image is None or image.thumbnail is not None: return
+    try:
+        with Image.open(io.BytesIO(image.data)) as original:
+            preview = ImageOps.exif_transpose(original).convert('RGB')
+            preview.thumbnail((320, 320))
+            out = io.BytesIO()
+            preview.save(out, 'JPEG', quality=80, optimize=True)
+    except (OSError, ValueError) as exc:
+        # Undecodable uploads won't get better on retry; the admin still sees the original
+        raise JobSkipped(f'Cannot thumbnail KYC image {digest}: {exc}')
+    image.thumbnail = out.getvalue()
+    db.session.commit()
+
+@job_handler('booking_email')
+def send_booking_email(booking_id):
+    booking = db.session.get(Booking, booking_id)
+    if booking is None: return
+    msg = Message(f'Booking confirmed: {booking.car.name} (#{booking.id})', recipients=[booking.user.email])
+    msg.body = render_template('email_booking.txt', booking=booking)
+    msg.attach(f'invoice-{booking.id}.html', 'text/html', render_template('invoice.html', booking=booking))
+    mail.send(msg)
+
+@job_handler('kyc_email')
+def send_kyc_email(user_id, status):
+    user = db.session.get(User, user_id)
+    if user is None: return
+    subject = 'Your DriveX account is verified' if status == 'Verified' else 'Your DriveX KYC needs another look'
+    msg = Message(subject, recipients=[user.email])
+    msg.body = render_template('email_kyc.txt', user=user, status=status)
+    mail.send(msg)
+
+class SMTPSink(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib/Flask-Mail: accepts everything and prints each message
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply(f'220 {socket.gethostname()} DriveX SMTP sink')
+        data = None
+        for raw in self.rfile:
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            if data is not None:
+                if line != '.':
+                    data.append(line[1:] if line.startswith('..') else line)
+                    continue
+                self.server.messages.append('\n'.join(data))
+                print('\n'.join(data) + '\n' + '-' * 60, flush=True)
+                data = None
+                self.reply('250 OK')
+                continue
+            verb = line[:4].upper()
+            if verb == 'DATA':
+                data = []
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+def start_smtp_sink(port):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), SMTPSink, bind_and_activate=False)
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    server.server_bind()
+    server.server_activate()
+    server.messages = []
+    return server
+
+# --- Chatbot ---
+# Intents live in chatbot_intents.json. Their patterns compile into one token trie, so a message
+# costs a few dict lookups per word however many intents there are. Matching works on whole words
+# ('hi' no longer fires inside 'this'); a trailing * matches any word starting with that stem.
+# A stem counts for less than an exact word, so specific intents beat broad ones on a tie.
+CHAT_TOKEN = re.compile(r'\w+')
+CHAT_BATCH_LIMIT = 100
+CHAT_STEM_SCORE = 0.75
+
+class ChatTrieNode:
+    __slots__ = ('children', 'stems', 'hits')
+
+    def __init__(self):
+        self.children, self.stems, self.hits = {}, {}, []
+
+class IntentMatcher:
+    def __init__(self, spec):
+        self.fallback = spec['fallback']
+        self.intents = []
+        self.root = ChatTrieNode()
+        for index, intent in enumerate(spec['intents']):
+            if not intent.get('name') or not intent.get('response') or not intent.get('patterns'):
+                raise ValueError(f'intent #{index + 1} needs a name, a response and patterns')
+            self.intents.append(intent)
+            weight = float(intent.get('weight', 1))
+            for pattern in intent['patterns']:
+                words = pattern.lower().split()
+                if not words or not all(CHAT_TOKEN.fullmatch(word.rstrip('*')) for word in words):
+                    raise ValueError(f"bad pattern {pattern!r} in intent {intent['name']!r}")
+                node = self.root
+                for word in words:
+                    branch = node.stems if word.endswith('*') else node.children
+                    node = branch.setdefault(word.rstrip('*'), ChatTrieNode())
+                # Longer phrases are more specific, so they score higher
+                node.hits.append((index, weight * sum(CHAT_STEM_SCORE if word.endswith('*') else 1 for word in words)))
+
+    def match(self, message):
+        words = CHAT_TOKEN.findall(message.lower())
+        scores = {}
+        for start in range(len(words)):
+            stack = [(self.root, start)]
+            while stack:
+                node, position = stack.pop()
+                for index, score in node.hits:
+                    scores[index] = scores.get(index, 0) + score
+                if position == len(words): continue
+                word = words[position]
+                if word in node.children: stack.append((node.children[word], position + 1))
+                if node.stems:
+                    stack.extend((node.stems[word[:size]], position + 1) for size in range(1, len(word) + 1) if word[:size] in node.stems)
+        if not scores: return None, 0
+        # Highest score wins; ties go to the intent listed first
+        index = max(scores, key=lambda i: (scores[i], -i))
+        return self.intents[index], scores[index]
+
+class ChatbotEngine:
+    def __init__(self, path, check_every=2.0):
+        self.path = path
+        self.check_every = check_every
+        self.lock = threading.Lock()
+        self.matcher, self.mtime, self.checked = None, None, 0.0
+
+    def reload(self):
+        # A broken file keeps the last good matcher and raises, so a bad edit never takes the bot down
+        with self.lock:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                self.matcher = IntentMatcher(json.load(f))
+            self.mtime, self.checked = mtime, time.monotonic()
+            return len(self.matcher.intents)
+
+    def current(self):
+        # Every worker notices an edited file within check_every seconds, no restart needed
+        if self.matcher is None or time.monotonic() - self.checked >= self.check_every:
+            self.checked = time.monotonic()
+            try:
+                if self.matcher is None or os.path.getmtime(self.path) != self.mtime: self.reload()
+            except (OSError, ValueError, KeyError, TypeError) as exc:
+                app.logger.warning(f'Chatbot intents not reloaded: {exc}')
+                if self.matcher is None: self.matcher = IntentMatcher({'fallback': "Sorry, I'm unavailable right now.", 'intents': []})
+        return self.matcher
+
+    def answer(self, message):
+        matcher = self.current()
+        intent, score = matcher.match(message)
+        if intent is None: return {'response': matcher.fallback, 'intent': None, 'score': 0}
+        return {'response': intent['response'], 'intent': intent['name'], 'score': score}
+
+chatbot_engine = ChatbotEngine(app.config['CHATBOT_INTENTS'])
 
 # --- Routes ---
 @app.route('/')
+@cached_page('cars', 'reviews')
 def home():
-    locations = [c[0] for c in db.session.query(Car.location).distinct().all()]
+    locations = list(fleet_facets.get()['location'])
     cars = Car.query.filter_by(is_available=True).all()
     return render_template('index.html', cars=cars, locations=locations)
 
@@ -135,7 +1711,10 @@ def login():
         email = request.form.get('email').lower()
         password = request.form.get('password')
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(user.password, password):
+        if user and hasher.check(user.password, password):
+            # Upgrade hashes made with an older cost setting while we still have the plain password
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.rehash(password)
             new_token = str(uuid.uuid4())
             user.session_token = new_token
             db.session.commit()
@@ -155,7 +1734,7 @@ def register():
         if User.query.filter_by(email=email).first():
             flash('Email exists')
             return redirect(url_for('login'))
-        hashed_pw = generate_password_hash(password, method='pbkdf2:sha256')
+        hashed_pw = hasher.hash(password)
         new_user = User(name=name, email=email, password=hashed_pw)
         db.session.add(new_user)
         db.session.commit()
@@ -163,42 +1742,96 @@ def register():
         return redirect(url_for('home'))
     return render_template('register.html')
 
-@app.route('/fleet')
-def fleet():
-    location = request.args.get('location')
-    category = request.args.get('category')
-    fuel_type = request.args.get('fuel_type')
-    seats = request.args.get('seats')
-    start_str = request.args.get('start_date')
-    end_str = request.args.get('end_date')
-
-    query = Car.query.filter_by(is_available=True)
-
-    if location and location != 'All': query = query.filter_by(location=location)
-    if category and category != 'All': query = query.filter_by(category=category)
-    if fuel_type and fuel_type != 'All': query = query.filter_by(fuel_type=fuel_type)
-    if seats and seats != 'All': query = query.filter_by(seats=int(seats))
-
+def filter_fleet(query, args):
+    location = args.get('location')
+    category = args.get('category')
+    fuel_type = args.get('fuel_type')
+    seats = args.get('seats')
+
+    query = query.filter(Car.is_available == True)
+    if location and location != 'All': query = query.filter(Car.location == location)
+    if category and category != 'All': query = query.filter(Car.category == category)
+    if fuel_type and fuel_type != 'All': query = query.filter(Car.fuel_type == fuel_type)
+    if seats and seats != 'All': query = query.filter(Car.seats == int(seats))
+    return query
+
+def parse_search_dates(args):
+    start_str = args.get('start_date')
+    end_str = args.get('end_date')
     if start_str and end_str:
         try:
-            req_start = datetime.strptime(start_str, '%Y-%m-%d')
-            req_end = datetime.strptime(end_str, '%Y-%m-%d').replace(hour=23, minute=59)
-            busy_subquery = db.session.query(Booking.car_id).filter(
-                Booking.status != 'Cancelled',
-                Booking.start_date < req_end,
-                Booking.end_date > req_start
-            ).subquery()
-            query = query.filter(Car.id.notin_(busy_subquery))
+            return (datetime.strptime(start_str, '%Y-%m-%d'),
+                    datetime.strptime(end_str, '%Y-%m-%d').replace(hour=23, minute=59))
         except ValueError:
             pass
+    return None, None
 
-    cars = query.all()
-    locations = [c[0] for c in db.session.query(Car.location).distinct().all()]
-    categories = [c[0] for c in db.session.query(Car.category).distinct().all()]
-    fuel_types = [c[0] for c in db.session.query(Car.fuel_type).distinct().all()]
-    seat_options = [c[0] for c in db.session.query(Car.seats).distinct().order_by(Car.seats).all()]
-
-    return render_template('fleet.html', cars=cars, locations=locations, categories=categories, fuel_types=fuel_types, seat_options=seat_options, current_filters=request.args)
+@app.route('/fleet')
+@cached_page('cars', 'reviews')
+def fleet():
+    cars = filter_fleet(Car.query, request.args).all()
+    req_start, req_end = parse_search_dates(request.args)
+    quotes = {}
+    if req_start:
+        busy = availability.busy_car_ids(req_start, req_end)
+        cars = [car for car in cars if car.id not in busy]
+        quotes = pricing.quote_many([car.id for car in cars], req_start, req_end)
+    facets = fleet_facets.get()
+
+    return render_template('fleet.html', cars=cars, locations=list(facets['location']), categories=list(facets['category']), fuel_types=list(facets['fuel_type']), seat_options=list(facets['seats']), facet_counts=facets, quotes=quotes, current_filters=request.args)
+
+API_FLEET_FIELDS = {
+    'id': (Car.id,), 'name': (Car.name,), 'category': (Car.category,), 'price_per_hr': (Car.price_per_hr,),
+    'image_url': (Car.image_url,), 'transmission': (Car.transmission,), 'fuel_type': (Car.fuel_type,),
+    'seats': (Car.seats,), 'location': (Car.location,), 'rating': (Car.rating_count, Car.rating_sum),
+}
+API_FLEET_SORTS = {'id': Car.id, 'name': Car.name, 'price_per_hr': Car.price_per_hr, 'seats': Car.seats}
+
+@app.route('/api/fleet')
+def api_fleet():
+    fields = [f for f in request.args.get('fields', '').split(',') if f] or list(API_FLEET_FIELDS)
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    if any(f not in API_FLEET_FIELDS for f in fields) or sort.lstrip('-') not in API_FLEET_SORTS:
+        return jsonify({'error': 'unknown field or sort key', 'fields': list(API_FLEET_FIELDS), 'sorts': list(API_FLEET_SORTS)}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    req_start, req_end = parse_search_dates(request.args)
+
+    # The answer only changes when cars (or, for date searches, bookings; for ratings, reviews)
+    # change, so polling clients get a 304 after a few primary-key lookups and no listing query
+    versions = get_version('cars') + (get_version('bookings') if req_start else '') + (get_version('reviews') if 'rating' in fields else '')
+    etag = hashlib.sha1(f'{versions}|{sorted(request.args.items(multi=True))}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    # Sort key first, id as tie-breaker, so the cursor order is total and stable
+    keys = [API_FLEET_SORTS[sort.lstrip('-')]] + ([Car.id] if sort.lstrip('-') != 'id' else [])
+    columns = list(dict.fromkeys(keys + [col for f in fields for col in API_FLEET_FIELDS[f]]))
+    try:
+        query = filter_fleet(db.session.query(*columns), request.args)
+    except ValueError:
+        return jsonify({'error': 'seats must be an integer'}), 400
+    if req_start:
+        busy = availability.busy_car_ids(req_start, req_end)
+        if busy: query = query.filter(Car.id.notin_(busy))
+    rows, next_cursor = keyset_page(query, keys, request.args.get('cursor'), descending=descending, page_size=limit)
+
+    cars = []
+    for row in rows:
+        car = {}
+        for f in fields:
+            if f == 'rating': car[f] = round(row.rating_sum / row.rating_count, 1) if row.rating_count else 5.0
+            else: car[f] = getattr(row, f)
+        cars.append(car)
+    response = jsonify({'cars': cars, 'next_cursor': next_cursor})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/kyc', methods=['GET', 'POST'])
 @login_required
@@ -211,17 +1844,45 @@ def kyc():
         current_user.phone = request.form.get('phone')
         current_user.address = request.form.get('address')
         current_user.gov_id = request.form.get('gov_id')
-        current_user.gov_id_image = request.form.get('gov_id_image_data')
-        current_user.user_selfie = request.form.get('user_selfie_data')
-        if not current_user.gov_id_image or not current_user.user_selfie:
+        gov_id_image = store_kyc_image(request.form.get('gov_id_image_data'))
+        user_selfie = store_kyc_image(request.form.get('user_selfie_data'))
+        if not gov_id_image or not user_selfie:
             flash('⚠️ Please upload both your ID and take a selfie.')
             return redirect(url_for('kyc'))
+        current_user.gov_id_image = gov_id_image
+        current_user.user_selfie = user_selfie
+        for digest in {gov_id_image, user_selfie}:
+            enqueue('kyc_thumbnail', digest=digest)
+        record_kyc_change(current_user.kyc_status, 'Pending')
         current_user.kyc_status = 'Pending'
         db.session.commit()
         flash('KYC Submitted! Please wait for Admin approval.')
         return redirect(url_for('dashboard'))
     return render_template('kyc.html')
 
+@app.route('/kyc/image/<digest>')
+@login_required
+def kyc_image(digest):
+    if not current_user.is_admin and digest not in (current_user.gov_id_image, current_user.user_selfie): abort(404)
+    thumbnail = db.session.query(KycImage.thumbnail).filter_by(digest=digest).scalar() if request.args.get('size') == 'thumb' else None
+    if thumbnail:
+        response = make_response(thumbnail)
+        response.headers['Content-Type'] = 'image/jpeg'
+        response.set_etag(digest + '-thumb')
+    else:
+        image = KycImage.query.options(db.undefer(KycImage.data)).get_or_404(digest)
+        response = make_response(image.data)
+        # Rows stored before the type check may hold anything; never let a browser render those
+        response.headers['Content-Type'] = image.mime_type if image.mime_type in KYC_IMAGE_TYPES else 'application/octet-stream'
+        response.set_etag(digest)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = 'sandbox'
+    # Content-addressed, so the bytes behind a digest never change. A thumbnail request answered
+    # with the original (job not run yet) must be revalidated so the preview shows up later.
+    immutable = thumbnail or request.args.get('size') != 'thumb'
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable' if immutable else 'private, no-cache'
+    return response.make_conditional(request)
+
 @app.route('/book/<int:car_id>', methods=['GET', 'POST'])
 @login_required
 def book_car_dates(car_id):
@@ -245,139 +1906,136 @@ def book_car_dates(car_id):
             flash("Invalid date format.")
             return redirect(url_for('book_car_dates', car_id=car.id))
 
-        duration_delta = end_date - start_date
-        days = duration_delta.days
-        if days < 1:
-            flash("❌ Minimum booking duration is 24 hours (1 Day).")
-            return redirect(url_for('book_car_dates', car_id=car.id))
-        if days > 30:
-            flash("❌ Maximum booking duration is 30 Days.")
+        duration_error = booking_duration_error(start_date, end_date)
+        if duration_error:
+            flash(duration_error)
             return redirect(url_for('book_car_dates', car_id=car.id))
 
-        collision = Booking.query.filter(
-            Booking.car_id == car.id,
-            Booking.status != 'Cancelled',
-            Booking.start_date < end_date,
-            Booking.end_date > start_date
-        ).first()
-
-        if collision:
+        if not availability.is_free(car.id, start_date, end_date):
             flash(f'❌ Unavailable! This car is already booked.')
             return redirect(url_for('book_car_dates', car_id=car.id))
+        try:
+            hold = place_hold(car.id, current_user.id, start_date, end_date)
+        except SlotTaken:
+            flash('❌ Unavailable! Someone else is checking out this car for those dates.')
+            return redirect(url_for('book_car_dates', car_id=car.id))
 
-        base_cost = int(days * 24 * car.price_per_hr) if days > 0 else int(duration_delta.seconds/3600 * car.price_per_hr)
-        if base_cost < car.price_per_hr: base_cost = car.price_per_hr * 24
-        
-        # ✅ FIX: Handle Delivery & Chauffeur Logic
         with_driver = 'with_driver' in request.form
         with_delivery = 'with_delivery' in request.form
-        
-        driver_fee = 500 if with_driver else 0
-        
-        # Logic: If chauffeur selected, delivery is FREE (or included). 
-        # If no chauffeur but delivery selected, CHARGE extra.
-        delivery_fee = 0
-        if with_delivery:
-            if not with_driver:
-                delivery_fee = 500  # Paid delivery if self-drive
-            else:
-                delivery_fee = 0    # Free delivery if with driver
-        
         delivery_address = request.form.get('delivery_address') if with_delivery else "Self Pickup"
-        delivery_type = "Delivery" if with_delivery else "Pickup"
-
-        tax = 648
-        total = base_cost + driver_fee + delivery_fee + tax
+        quote = pricing.quote(car.id, start_date, end_date, with_driver, with_delivery)
 
         return render_template('booking_payment.html', 
                                car=car, start_date=start_str, end_date=end_str,
-                               base_cost=base_cost, driver_fee=driver_fee, 
-                               delivery_fee=delivery_fee, delivery_type=delivery_type,
+                               base_cost=quote['base_cost'], driver_fee=quote['driver_fee'], 
+                               delivery_fee=quote['delivery_fee'], delivery_type="Delivery" if with_delivery else "Pickup",
                                delivery_address=delivery_address,
-                               tax=tax, discount=0, total=total,
-                               with_driver=with_driver)
+                               tax=quote['tax'], discount=0, total=quote['total'],
+                               with_driver=with_driver, hold_token=hold.token,
+                               quote_token=sign_quote(quote, current_user.id, start_date, end_date, with_delivery, delivery_address))
 
     return render_template('booking_dates.html', car=car)
 
 @app.route('/book/apply-coupon', methods=['POST'])
 @login_required
 def apply_coupon():
-    car_id = request.form.get('car_id')
-    start_str = request.form.get('start_date')
-    end_str = request.form.get('end_date')
-    
-    with_driver = request.form.get('with_driver') == 'True'
-    # ✅ Retrieve delivery info
-    delivery_fee = float(request.form.get('delivery_fee', 0))
-    delivery_type = request.form.get('delivery_type')
-    delivery_address = request.form.get('delivery_address')
-
-    coupon_code = request.form.get('coupon_code').strip().upper()
+    car = Car.query.get_or_404(request.form.get('car_id', type=int))
+    # Re-prices the quote book_car_dates signed, so the dates and options were already checked there
+    signed = load_quote(request.form.get('quote_token'), current_user.id, car.id)
+    if not signed:
+        flash('⚠️ Your price quote has expired. Please select your dates again.')
+        return redirect(url_for('book_car_dates', car_id=car.id))
+    start_date, end_date = signed['start'], signed['end']
+    with_driver = signed['driver_fee'] > 0
+    with_delivery = signed['with_delivery']
+    delivery_type = 'Delivery' if with_delivery else 'Pickup'
+    delivery_address = signed['delivery_address']
+    start_str, end_str = f'{start_date:%Y-%m-%dT%H:%M}', f'{end_date:%Y-%m-%dT%H:%M}'
+
+    coupon_code = request.form.get('coupon_code', '').strip().upper()
+    hold_token = request.form.get('hold_token')
     
-    car = Car.query.get_or_404(car_id)
-    start_date = datetime.strptime(start_str, '%Y-%m-%dT%H:%M')
-    end_date = datetime.strptime(end_str, '%Y-%m-%dT%H:%M')
-    duration_hours = (end_date - start_date).total_seconds() / 3600
-    
-    base_cost = int(duration_hours * car.price_per_hr)
-    driver_fee = 500 if with_driver else 0
-    tax = 648
-    
-    discount = 0
-    coupon = Coupon.query.filter_by(code=coupon_code, is_active=True).first()
-    if coupon:
-        discount = coupon.discount_amount
-        flash(f'✅ Coupon Applied! You saved ₹{discount}')
+    quote = pricing.quote(car.id, start_date, end_date, with_driver, with_delivery, coupon_code)
+    if quote['coupon']:
+        flash(f"✅ Coupon Applied! You saved ₹{quote['discount']}")
     else:
         flash('❌ Invalid or Expired Coupon Code')
-    
-    total_cost = max(0, (base_cost + driver_fee + delivery_fee + tax) - discount)
 
     return render_template('booking_payment.html', 
                            car=car, start_date=start_str, end_date=end_str,
-                           base_cost=base_cost, driver_fee=driver_fee, 
-                           delivery_fee=delivery_fee, delivery_type=delivery_type,
+                           base_cost=quote['base_cost'], driver_fee=quote['driver_fee'], 
+                           delivery_fee=quote['delivery_fee'], delivery_type=delivery_type,
                            delivery_address=delivery_address,
-                           tax=tax, discount=discount, total=total_cost, 
-                           with_driver=with_driver,
-                           applied_coupon=coupon_code if discount > 0 else "")
+                           tax=quote['tax'], discount=quote['discount'], total=quote['total'], 
+                           with_driver=with_driver, hold_token=hold_token,
+                           quote_token=sign_quote(quote, current_user.id, start_date, end_date, with_delivery, delivery_address),
+                           applied_coupon=quote['coupon'])
 
 @app.route('/book/confirm/<int:car_id>', methods=['POST'])
 @login_required
 def confirm_booking(car_id):
     car = Car.query.get_or_404(car_id)
-    start_str = request.form.get('start_date')
-    end_str = request.form.get('end_date')
-    start_date = datetime.strptime(start_str, '%Y-%m-%dT%H:%M')
-    end_date = datetime.strptime(end_str, '%Y-%m-%dT%H:%M')
-
-    def safe_float(val):
-        try: return float(val)
-        except (ValueError, TypeError): return 0.0
+    # Amounts come from the signed quote, never from the posted form
+    quote = load_quote(request.form.get('quote_token'), current_user.id, car.id)
+    if not quote:
+        flash('⚠️ Your price quote has expired. Please select your dates again.')
+        return redirect(url_for('book_car_dates', car_id=car.id))
 
     new_booking = Booking(
         user_id=current_user.id,
         car_id=car.id,
-        base_cost=safe_float(request.form.get('base_cost')),
-        driver_cost=safe_float(request.form.get('driver_fee')),
-        
-        # ✅ Save Delivery Info
-        delivery_fee=safe_float(request.form.get('delivery_fee')),
-        delivery_type=request.form.get('delivery_type'),
-        delivery_address=request.form.get('delivery_address'),
-
-        discount=safe_float(request.form.get('discount')),
-        total_cost=safe_float(request.form.get('total_cost')),
-        with_driver=request.form.get('with_driver') == 'True',
+        base_cost=quote['base_cost'],
+        driver_cost=quote['driver_fee'],
+        delivery_fee=quote['delivery_fee'],
+        delivery_type='Delivery' if quote['with_delivery'] else 'Pickup',
+        delivery_address=quote['delivery_address'],
+        discount=quote['discount'],
+        total_cost=quote['total'],
+        with_driver=quote['driver_fee'] > 0,
         payment_method=request.form.get('payment_method'),
         status='Paid' if request.form.get('payment_method') != 'cod' else 'Confirmed',
-        start_date=start_date,
-        end_date=end_date
+        coupon_code=quote['coupon'] or None,
+        start_date=quote['start'],
+        end_date=quote['end']
     )
-    db.session.add(new_booking)
-    db.session.commit()
+    try:
+        convert_hold(request.form.get('hold_token'), new_booking)
+    except SlotTaken:
+        flash('❌ Sorry, this car was booked by someone else for those dates.')
+        return redirect(url_for('book_car_dates', car_id=car.id))
+    except CouponUnavailable:
+        flash(f"❌ Coupon {quote['coupon']} has expired or reached its usage limit. Your dates are still held, please continue without it.")
+        return redirect(url_for('book_car_dates', car_id=car.id))
     return redirect(url_for('booking_success', booking_id=new_booking.id))
 
+API_QUOTE_MAX_CARS = 100
+
+@app.route('/api/quote', methods=['GET', 'POST'])
+def api_quote():
+    params = request.get_json(silent=True) or request.values
+    car_ids = params.get('car_ids') or []
+    if isinstance(car_ids, str): car_ids = car_ids.split(',')
+    try:
+        car_ids = list(dict.fromkeys(int(car_id) for car_id in car_ids))
+        start, end = (datetime.fromisoformat(params.get(key)) for key in ('start', 'end'))
+        # Offsets are converted to the naive UTC the rest of the app uses
+        start, end = (d.astimezone(timezone.utc).replace(tzinfo=None) if d.tzinfo else d for d in (start, end))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'car_ids, start and end (ISO 8601) are required'}), 400
+    if len(car_ids) > API_QUOTE_MAX_CARS: return jsonify({'error': f'at most {API_QUOTE_MAX_CARS} car_ids per request'}), 400
+    if start < datetime.utcnow(): return jsonify({'error': 'start must be in the future'}), 400
+    duration_error = booking_duration_error(start, end)
+    if duration_error: return jsonify({'error': duration_error.lstrip('❌ ')}), 400
+    truthy = ('1', 'true', 'True', True)
+    # Coupons are only priced for signed-in customers, as on the checkout page
+    coupon = str(params.get('coupon', '')).strip().upper() if current_user.is_authenticated else ''
+    quotes = pricing.quote_many(car_ids, start, end, params.get('with_driver') in truthy,
+                                params.get('with_delivery') in truthy, coupon)
+    busy = availability.busy_car_ids(start, end)
+    for car_id, quote in quotes.items():
+        quote['available'] = car_id not in busy
+    return jsonify({'start': start.isoformat(), 'end': end.isoformat(), 'quotes': list(quotes.values())})
+
 @app.route('/booking/success/<int:booking_id>')
 @login_required
 def booking_success(booking_id):
@@ -396,12 +2054,20 @@ def invoice(booking_id):
 @app.route('/review/submit', methods=['POST'])
 @login_required
 def submit_review():
+    car_id = int(request.form.get('car_id'))
+    rating = int(request.form.get('rating'))
     db.session.add(Review(
         user_id=current_user.id, 
-        car_id=request.form.get('car_id'), 
-        rating=int(request.form.get('rating')), 
+        car_id=car_id, 
+        rating=rating, 
         comment=request.form.get('comment')
     ))
+    # Single UPDATE so concurrent reviews can't lose increments
+    Car.query.filter_by(id=car_id).update({
+        Car.rating_count: Car.rating_count + 1,
+        Car.rating_sum: Car.rating_sum + rating
+    }, synchronize_session=False)
+    bump_version('reviews')
     db.session.commit()
     return redirect(url_for('my_bookings'))
 
@@ -409,7 +2075,9 @@ def submit_review():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    recent_bookings = Booking.query.filter_by(user_id=current_user.id).order_by(Booking.date_booked.desc()).limit(3).all()
+    recent_bookings = Booking.query.options(
+        db.joinedload(Booking.car).load_only(Car.name, Car.image_url)
+    ).filter_by(user_id=current_user.id).order_by(Booking.date_booked.desc()).limit(3).all()
     return render_template('dashboard.html', bookings=recent_bookings)
 
 @app.route('/profile', methods=['GET', 'POST'])
@@ -427,22 +2095,27 @@ def profile():
 @app.route('/my-bookings')
 @login_required
 def my_bookings():
-    bookings = Booking.query.filter_by(user_id=current_user.id).order_by(Booking.date_booked.desc()).all()
-    return render_template('my_bookings.html', bookings=bookings)
+    query = Booking.query.options(
+        db.joinedload(Booking.car).load_only(Car.name, Car.image_url)
+    ).filter_by(user_id=current_user.id)
+    bookings, next_cursor = keyset_page(query, [Booking.date_booked, Booking.id], request.args.get('cursor'))
+    return render_template('my_bookings.html', bookings=bookings, next_cursor=next_cursor)
 
 @app.route('/security', methods=['GET', 'POST'])
 @login_required
 def security():
     if request.method == 'POST':
-        current_user.password = generate_password_hash(request.form.get('new_password'), method='pbkdf2:sha256')
+        current_user.password = hasher.hash(request.form.get('new_password'))
         db.session.commit()
         flash('Password changed successfully.')
     return render_template('security.html')
 
 @app.route('/help')
+@cached_page()
 def help_support(): return render_template('help.html')
 
 @app.route('/about')
+@cached_page()
 def about(): return render_template('about.html')
 
 @app.route('/contact', methods=['GET', 'POST'])
@@ -457,16 +2130,63 @@ def logout():
 
 @app.route('/admin')
 @login_required
+@replica_reads()
 def admin_dashboard():
     if not current_user.is_admin: return redirect(url_for('home'))
-    stats = {
-        'total_fleet': Car.query.count(),
-        'active_bookings': Booking.query.filter(Booking.status != 'Cancelled').count(),
-        'pending_kyc': User.query.filter_by(kyc_status='Pending').count(),
-        'revenue': db.session.query(db.func.sum(Booking.total_cost)).filter(Booking.status != 'Cancelled').scalar() or 0
-    }
-    pending_users = User.query.filter_by(kyc_status='Pending').all()
-    return render_template('admin.html', stats=stats, pending_users=pending_users)
+    stats = dashboard_stats()
+    since = datetime.utcnow().date() - timedelta(days=29)
+    daily = dict(db.session.query(DailyStat.day, db.func.sum(DailyStat.revenue)).filter(DailyStat.day >= since).group_by(DailyStat.day).all())
+    revenue_by_day = [(day, daily.get(day, 0)) for day in (since + timedelta(days=i) for i in range(30))]
+    pending_users = User.query.options(
+        db.load_only(User.name, User.email, User.gov_id_image, User.user_selfie)
+    ).filter_by(kyc_status='Pending').all()
+    last_sweep = LifecycleRun.query.order_by(LifecycleRun.ran_at.desc()).first()
+    return render_template('admin.html', stats=stats, pending_users=pending_users, revenue_by_day=revenue_by_day,
+                           max_daily_revenue=max([revenue for _, revenue in revenue_by_day] + [1]), last_sweep=last_sweep)
+
+@app.route('/admin/analytics')
+@login_required
+@replica_reads()
+def analytics():
+    if not current_user.is_admin: return redirect(url_for('home'))
+    today = datetime.utcnow().date()
+    try:
+        last_day = date.fromisoformat(request.args['end']) if request.args.get('end') else today
+        first_day = date.fromisoformat(request.args['start']) if request.args.get('start') else last_day - timedelta(days=29)
+    except ValueError:
+        first_day = last_day = None
+    if not first_day or first_day > last_day or (last_day - first_day).days >= ANALYTICS_MAX_DAYS:
+        error = f'start and end must be YYYY-MM-DD dates, at most {ANALYTICS_MAX_DAYS} days apart'
+        if request.args.get('format') == 'json': return jsonify({'error': error}), 400
+        flash(f'⚠️ {error}.')
+        return redirect(url_for('analytics'))
+    report = cached_fleet_utilization(first_day, last_day)
+    if request.args.get('format') == 'json': return jsonify(report)
+    return render_template('analytics.html', report=report)
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if not (token and request.headers.get('Authorization') == f'Bearer {token}'):
+        if not current_user.is_authenticated or not current_user.is_admin: abort(404)
+    return Response(render_prometheus(request_metrics.collect()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/chatbot/reload', methods=['POST'])
+@login_required
+def reload_chatbot():
+    if not current_user.is_admin: return redirect(url_for('home'))
+    try:
+        return jsonify({'intents': chatbot_engine.reload()})
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        return jsonify({'error': str(exc)}), 400
+
+@app.route('/admin/hash-stats')
+@login_required
+def hash_stats():
+    if not current_user.is_admin: return redirect(url_for('home'))
+    stats = hasher.snapshot()
+    stats['buckets'] = dict(zip([str(b) for b in HASH_LATENCY_BUCKETS] + ['+Inf'], stats['buckets']))
+    return jsonify(stats)
 
 @app.route('/admin/approve-kyc/<int:user_id>')
 @login_required
@@ -474,7 +2194,9 @@ def approve_kyc(user_id):
     if not current_user.is_admin: return redirect(url_for('home'))
     user = User.query.get(user_id)
     if user:
+        record_kyc_change(user.kyc_status, 'Verified')
         user.kyc_status = 'Verified'
+        enqueue('kyc_email', user_id=user.id, status='Verified')
         db.session.commit()
     return redirect(url_for('admin_dashboard'))
 
@@ -484,7 +2206,9 @@ def reject_kyc(user_id):
     if not current_user.is_admin: return redirect(url_for('home'))
     user = User.query.get(user_id)
     if user:
+        record_kyc_change(user.kyc_status, 'Rejected')
         user.kyc_status = 'Rejected'
+        enqueue('kyc_email', user_id=user.id, status='Rejected')
         db.session.commit()
     return redirect(url_for('admin_dashboard'))
 
@@ -493,23 +2217,43 @@ def reject_kyc(user_id):
 def manage_cars():
     if not current_user.is_admin: return redirect(url_for('home'))
     if request.method == 'POST':
-        db.session.add(Car(
-            name=request.form.get('name'), 
-            price_per_hr=int(request.form.get('price')), 
-            image_url=request.form.get('image'), 
-            category=request.form.get('category'), 
-            location=request.form.get('location'),
-            transmission="Auto", fuel_type="Petrol", seats=5
-        ))
-        db.session.commit()
+        values, error = validate_car_row({
+            'name': request.form.get('name'), 'price_per_hr': request.form.get('price'), 'image_url': request.form.get('image'),
+            'category': request.form.get('category'), 'location': request.form.get('location'),
+            'transmission': request.form.get('transmission'), 'fuel_type': request.form.get('fuel_type'), 'seats': request.form.get('seats'),
+        })
+        if error:
+            flash(f'⚠️ Car not added: {error}.')
+        else:
+            db.session.add(Car(**values))
+            bump_stat('total_fleet', 1)
+            bump_version('cars')
+            db.session.commit()
     cars = Car.query.all()
-    return render_template('manage_cars.html', cars=cars)
+    return render_template('manage_cars.html', cars=cars, transmissions=CAR_TRANSMISSIONS, fuel_types=CAR_FUEL_TYPES)
+
+@app.route('/admin/cars/import', methods=['POST'])
+@login_required
+def import_cars_upload():
+    if not current_user.is_admin: return redirect(url_for('home'))
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        if request.accept_mimetypes.best == 'application/json': return jsonify({'error': 'attach a CSV or JSONL file as "file"'}), 400
+        flash('⚠️ Choose a CSV or JSONL file to import.')
+        return redirect(url_for('manage_cars'))
+    result = import_cars(read_import_rows(upload.stream, upload.filename))
+    if request.accept_mimetypes.best == 'application/json': return jsonify(result)
+    flash(f"✅ Imported {result['imported']} cars." + (f" {result['failed']} rows skipped: " + '; '.join(
+        f"line {e['line']}: {e['error']}" for e in result['errors'][:5]) if result['failed'] else ''))
+    return redirect(url_for('manage_cars'))
 
 @app.route('/admin/cars/delete/<int:id>')
 @login_required
 def delete_car(id):
     if not current_user.is_admin: return redirect(url_for('home'))
     db.session.delete(Car.query.get(id))
+    bump_stat('total_fleet', -1)
+    bump_version('cars')
     db.session.commit()
     return redirect(url_for('manage_cars'))
 
@@ -518,40 +2262,150 @@ def delete_car(id):
 def manage_coupons():
     if not current_user.is_admin: return redirect(url_for('home'))
     if request.method == 'POST':
-        db.session.add(Coupon(code=request.form.get('code').upper(), discount_amount=int(request.form.get('discount'))))
-        db.session.commit()
+        code = request.form.get('code', '').strip().upper()
+        try:
+            discount = int(request.form.get('discount'))
+            starts_at, expires_at = [datetime.strptime(request.form[f], '%Y-%m-%dT%H:%M') if request.form.get(f) else None for f in ('starts_at', 'expires_at')]
+            max_redemptions, per_user_limit = [int(request.form[f]) if request.form.get(f) else None for f in ('max_redemptions', 'per_user_limit')]
+        except ValueError:
+            flash('⚠️ Check the discount, dates and limits.')
+            return redirect(url_for('manage_coupons'))
+        if not code or len(code) > 20 or discount <= 0:
+            flash('⚠️ Enter a code of up to 20 characters and a positive discount.')
+        elif Coupon.query.filter_by(code=code).first():
+            flash(f'⚠️ Coupon {code} already exists.')
+        elif starts_at and expires_at and expires_at <= starts_at:
+            flash('⚠️ The coupon must expire after it starts.')
+        else:
+            db.session.add(Coupon(code=code, discount_amount=discount, starts_at=starts_at, expires_at=expires_at,
+                                  max_redemptions=max_redemptions, per_user_limit=per_user_limit))
+            bump_version('coupons')
+            db.session.commit()
     coupons = Coupon.query.all()
-    return render_template('manage_coupons.html', coupons=coupons)
+    return render_template('manage_coupons.html', coupons=coupons, now=datetime.utcnow())
 
 @app.route('/admin/coupons/delete/<int:id>')
 @login_required
 def delete_coupon(id):
     if not current_user.is_admin: return redirect(url_for('home'))
-    db.session.delete(Coupon.query.get(id))
+    coupon = Coupon.query.get_or_404(id)
+    # Used coupons are retired rather than deleted so their redemption history stays intact
+    if coupon.redemptions: coupon.is_active = False
+    else: db.session.delete(coupon)
+    bump_version('coupons')
     db.session.commit()
     return redirect(url_for('manage_coupons'))
 
 @app.route('/admin/bookings')
 @login_required
+@replica_reads()
 def manage_bookings():
     if not current_user.is_admin: return redirect(url_for('home'))
-    return render_template('manage_bookings.html', bookings=Booking.query.order_by(Booking.date_booked.desc()).all())
+    query = Booking.query.options(
+        db.joinedload(Booking.car).load_only(Car.name),
+        db.joinedload(Booking.user).load_only(User.name, User.phone)
+    )
+    bookings, next_cursor = keyset_page(query, [Booking.date_booked, Booking.id], request.args.get('cursor'))
+    return render_template('manage_bookings.html', bookings=bookings, next_cursor=next_cursor, statuses=BOOKING_STATUSES)
+
+EXPORT_COLUMNS = [
+    ('id', Booking.id), ('date_booked', Booking.date_booked), ('customer', User.email), ('car', Car.name),
+    ('location', Car.location), ('status', Booking.status), ('start_date', Booking.start_date), ('end_date', Booking.end_date),
+    ('base_cost', Booking.base_cost), ('driver_cost', Booking.driver_cost), ('delivery_fee', Booking.delivery_fee),
+    ('discount', Booking.discount), ('total_cost', Booking.total_cost), ('payment_method', Booking.payment_method)
+]
+
+@app.route('/admin/bookings/export')
+@login_required
+@replica_reads()
+def export_bookings():
+    if not current_user.is_admin: return redirect(url_for('home'))
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'): abort(400)
+    query = db.select(*[col for _, col in EXPORT_COLUMNS]).select_from(Booking).outerjoin(Car, Booking.car_id == Car.id).outerjoin(User, Booking.user_id == User.id)
+    try:
+        if request.args.get('from'): query = query.where(Booking.date_booked >= datetime.strptime(request.args['from'], '%Y-%m-%d'))
+        if request.args.get('to'): query = query.where(Booking.date_booked < datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1))
+    except ValueError:
+        abort(400)
+    if request.args.get('status'): query = query.where(Booking.status == request.args['status'])
+    if request.args.get('location'): query = query.where(Car.location == request.args['location'])
+    # yield_per streams rows through a server-side cursor instead of buffering the result
+    query = query.order_by(Booking.id).execution_options(yield_per=1000)
+    names = [name for name, _ in EXPORT_COLUMNS]
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            # The header goes out before the query runs, so the download starts straight away
+            writer.writerow(names)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # The body streams after the view returns, so it opens its own replica scope
+        with replica_reads():
+            rows = db.session.execute(query)
+        for partition in rows.partitions():
+            for row in partition:
+                values = [v.isoformat() if isinstance(v, datetime) else v for v in row]
+                if fmt == 'csv': writer.writerow(values)
+                else: buffer.write(json.dumps(dict(zip(names, values))) + '\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=bookings.{fmt}'
+    return response
 
 @app.route('/admin/booking/update/<int:id>/<status>')
 @login_required
 def update_booking(id, status):
     if not current_user.is_admin: return redirect(url_for('home'))
-    booking = Booking.query.get(id)
-    if booking:
-        booking.status = status
-        db.session.commit()
+    bulk_update_booking_status({id: status})
+    return redirect(url_for('manage_bookings'))
+
+@app.route('/admin/bookings/status', methods=['POST'])
+@login_required
+def bulk_booking_status():
+    # JSON: {"updates": [{"id": 1, "status": "Completed"}, ...]} or {"ids": [...], "status": "..."};
+    # the bookings page posts the same ids/status pair as a form
+    if not current_user.is_admin: return redirect(url_for('home'))
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {'ids': request.form.getlist('ids'), 'status': request.form.get('status')}
+    if isinstance(payload, dict) and isinstance(payload.get('updates'), list):
+        pairs = [(item.get('id'), item.get('status')) if isinstance(item, dict) else (item, None) for item in payload['updates']]
+    elif isinstance(payload, dict) and isinstance(payload.get('ids'), list):
+        pairs = [(booking_id, payload.get('status')) for booking_id in payload['ids']]
+    else:
+        return jsonify({'error': 'expected "updates" or "ids" and "status"'}), 400
+    if len(pairs) > BULK_STATUS_LIMIT:
+        return jsonify({'error': f'at most {BULK_STATUS_LIMIT} bookings per request'}), 400
+    updates, errors = {}, []
+    for booking_id, status in pairs:
+        try:
+            updates[int(booking_id)] = status
+        except (TypeError, ValueError):
+            errors.append({'id': booking_id, 'error': 'id must be an integer'})
+    result = bulk_update_booking_status(updates)
+    result['failed'] += len(errors)
+    result['errors'] = (errors + result['errors'])[:BULK_ERROR_LIMIT]
+    if request.is_json: return jsonify(result)
+    flash(f"✅ Updated {result['updated']} bookings." + (f" {result['failed']} failed." if result['failed'] else ''))
     return redirect(url_for('manage_bookings'))
 
 @app.route('/admin/users')
 @login_required
+@replica_reads()
 def manage_users():
     if not current_user.is_admin: return redirect(url_for('home'))
-    return render_template('manage_users.html', users=User.query.all())
+    query = User.query.options(db.load_only(User.name, User.email, User.is_admin))
+    users, next_cursor = keyset_page(query, [User.id], request.args.get('cursor'), descending=False)
+    return render_template('manage_users.html', users=users, next_cursor=next_cursor)
 
 @app.route('/admin/users/delete/<int:id>')
 @login_required
@@ -559,10 +2413,253 @@ def delete_user(id):
     if not current_user.is_admin: return redirect(url_for('home'))
     user = User.query.get(id)
     if user and not user.is_admin:
+        record_kyc_change(user.kyc_status, None)
         db.session.delete(user)
         db.session.commit()
     return redirect(url_for('manage_users'))
 
+# --- CLI ---
+@app.cli.command('migrate-kyc-images')
+def migrate_kyc_images():
+    """Move legacy inline base64 KYC images into the KycImage store."""
+    db.create_all()
+    moved = 0
+    legacy = User.query.filter(db.or_(User.gov_id_image.like('data:%'), User.user_selfie.like('data:%'))).all()
+    for user in legacy:
+        if user.gov_id_image and user.gov_id_image.startswith('data:'):
+            user.gov_id_image = store_kyc_image(user.gov_id_image)
+        if user.user_selfie and user.user_selfie.startswith('data:'):
+            user.user_selfie = store_kyc_image(user.user_selfie)
+        for digest in {user.gov_id_image, user.user_selfie} - {None}:
+            enqueue('kyc_thumbnail', digest=digest)
+        db.session.commit()
+        moved += 1
+    print(f"Moved KYC images for {moved} users.")
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings():
+    """Recompute Car.rating_count/rating_sum from the Review table."""
+    print(f"Rebuilt ratings for {recompute_ratings()} reviewed cars.")
+
+def recompute_ratings():
+    totals = {car_id: (count, total) for car_id, count, total in db.session.query(
+        Review.car_id, db.func.count(Review.id), db.func.sum(Review.rating)
+    ).group_by(Review.car_id).all()}
+    for car in Car.query.all():
+        car.rating_count, car.rating_sum = totals.get(car.id, (0, 0))
+    db.session.commit()
+    return len(totals)
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Recompute the dashboard counters and daily revenue rollup from scratch."""
+    counters = reconcile_stats()
+    print(', '.join(f'{name}={value}' for name, value in counters.items()))
+
+@app.cli.command('sweep-holds')
+def sweep_holds():
+    """Delete reservation holds that have expired."""
+    print(f"Removed {sweep_expired_holds()} expired holds.")
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty instead of polling.')
+@click.option('--poll', default=2.0, help='Seconds to wait between polls of an empty queue.')
+def worker(once, poll):
+    """Run queued background jobs (emails, KYC thumbnails)."""
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    print(f'Processed {work_jobs(worker_id, once=once, poll=poll)} jobs.')
+
+@app.cli.command('smtp-sink')
+@click.option('--port', default=1025, help='Port to listen on (matches the MAIL_PORT default).')
+def smtp_sink(port):
+    """Accept mail locally and print it instead of delivering it."""
+    print(f'SMTP sink listening on 127.0.0.1:{port}')
+    start_smtp_sink(port).serve_forever()
+
+@app.cli.command('sweep-bookings')
+@click.option('--chunk-size', default=LIFECYCLE_CHUNK, help='Bookings updated per transaction.')
+def sweep_bookings(chunk_size):
+    """Mark started bookings Active and ended bookings Completed."""
+    counts = sweep_booking_lifecycle(chunk_size=chunk_size)
+    print(f"Marked {counts['Active']} bookings Active and {counts['Completed']} Completed.")
+
+# Indexes dropped from the models that migrate-db removes from existing databases
+RETIRED_INDEXES = {'booking': ['ix_booking_status']}  # covered by ix_booking_status_end
+
+@app.cli.command('migrate-db')
+def migrate_db():
+    """Create missing tables, columns and indexes and drop retired indexes without touching existing data."""
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing: continue
+                ddl = f'ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} ADD COLUMN {col.name} {col.type.compile(dialect=conn.dialect)}'
+                if col.default is not None and col.default.is_scalar:
+                    ddl += f' DEFAULT {col.default.arg!r}'
+                conn.exec_driver_sql(ddl)
+                print(f'Added column {table.name}.{col.name}')
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in indexes: continue
+                index.create(bind=conn)
+                print(f'Created index {index.name}')
+            for name in RETIRED_INDEXES.get(table.name, []):
+                if name not in indexes: continue
+                conn.exec_driver_sql(f'DROP INDEX {conn.dialect.identifier_preparer.quote(name)}')
+                print(f'Dropped index {name}')
+    print('Schema is up to date.')
+
+# --- Synthetic Data ---
+SEED_LOCATIONS = {'Mumbai': 30, 'Delhi': 25, 'Bangalore': 20, 'Pune': 10, 'Hyderabad': 10, 'Chennai': 5}
+SEED_MODELS = [
+    # (name, category, price_per_hr, transmission, fuel_type, seats, weight)
+    ('Maruti Suzuki Swift', 'Hatchback', 75, 'Manual', 'Petrol', 5, 20),
+    ('Hyundai i20', 'Hatchback', 95, 'Auto', 'Petrol', 5, 15),
+    ('Tata Nexon EV', 'SUV', 140, 'Auto', 'Electric', 5, 10),
+    ('Honda City', 'Sedan', 120, 'Auto', 'Petrol', 5, 15),
+    ('Mahindra Thar', 'SUV', 180, 'Manual', 'Diesel', 4, 8),
+    ('Toyota Innova Crysta', 'MUV', 200, 'Manual', 'Diesel', 7, 10),
+    ('Kia Seltos', 'SUV', 150, 'Auto', 'Diesel', 5, 12),
+    ('Toyota Fortuner', 'SUV', 300, 'Auto', 'Diesel', 7, 5),
+    ('Mercedes-Benz C-Class', 'Luxury', 600, 'Auto', 'Petrol', 5, 3),
+]
+SEED_IMAGE = 'https://images.unsplash.com/photo-1549317661-bd32c8ce0db2?w=600'
+SEED_TRIP_DAYS = ([1, 2, 3, 4, 5, 7, 10, 14, 30], [30, 22, 15, 10, 8, 7, 4, 3, 1])
+SEED_MAX_UTILIZATION = 0.85  # Busiest cars still have some idle time between trips
+
+def seed_booking_counts(targets, capacity):
+    # Cars that would be booked past the window are capped and their excess goes to the others
+    counts, open_cars = [0] * len(targets), list(range(len(targets)))
+    remaining = sum(targets)
+    while remaining > 0 and open_cars:
+        weight = sum(targets[i] for i in open_cars) or 1
+        share = {i: remaining * targets[i] / weight for i in open_cars}
+        remaining = 0
+        for i in list(open_cars):
+            want = counts[i] + share[i]
+            if want >= capacity:
+                remaining += want - capacity
+                counts[i] = capacity
+                open_cars.remove(i)
+            else:
+                counts[i] = want
+        if remaining < 1: break
+    return [round(count) for count in counts]
+
+def insert_batches(model, rows, batch_size):
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(db.insert(model), rows[i:i + batch_size])
+        db.session.commit()
+
+@app.cli.command('seed-data')
+@click.option('--cars', default=200, help='Cars to add.')
+@click.option('--users', default=5000, help='Customers to add.')
+@click.option('--bookings', default=50000, help='Bookings to add (approximate, spread over the cars).')
+@click.option('--reviews', default=10000, help='Reviews to add for past bookings.')
+@click.option('--days', default=365, help='Days of booking history before today.')
+@click.option('--ahead', default=30, help='Days after today that future bookings may reach.')
+@click.option('--seed', default=42, help='Random seed, so runs are reproducible.')
+@click.option('--batch-size', default=5000, help='Rows per INSERT batch.')
+def seed_data(cars, users, bookings, reviews, days, ahead, seed, batch_size):
+    """Bulk-insert realistic synthetic cars, users, bookings and reviews."""
+    rng = random.Random(seed)
+    db.create_all()
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+    locations, location_weights = list(SEED_LOCATIONS), list(SEED_LOCATIONS.values())
+    car_rows = []
+    for _ in range(cars):
+        name, category, price, transmission, fuel_type, seats, _weight = rng.choices(SEED_MODELS, [m[-1] for m in SEED_MODELS])[0]
+        car_rows.append(dict(name=name, category=category, price_per_hr=price, transmission=transmission, fuel_type=fuel_type,
+                             seats=seats, location=rng.choices(locations, location_weights)[0], image_url=SEED_IMAGE,
+                             is_available=rng.random() > 0.05, rating_count=0, rating_sum=0))
+    insert_batches(Car, car_rows, batch_size)
+
+    # Every seeded user shares one hash so seeding doesn't spend minutes in pbkdf2
+    first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    password = generate_password_hash('password', method=app.config['PASSWORD_HASH_METHOD'])
+    user_rows = [dict(name=f'Customer {n}', email=f'customer{n}@example.com', password=password, is_admin=False,
+                      kyc_status=rng.choices(['Verified', 'Pending', 'Unverified', 'Rejected'], [80, 5, 12, 3])[0])
+                 for n in range(first_user, first_user + users)]
+    insert_batches(User, user_rows, batch_size)
+
+    car_list = db.session.query(Car.id, Car.price_per_hr).order_by(Car.id.desc()).limit(cars).all()
+    user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.id >= first_user).all()]
+    # Popularity is long-tailed: a few cars take most of the bookings
+    popularity = [1.0 / (rank + 1) ** 0.8 for rank in range(len(car_list))]
+    total_popularity = sum(popularity)
+    # Every trip falls inside [now - days, now + ahead]; a car takes no more trips than fit in it
+    window_start = now - timedelta(days=days)
+    window_hours = (days + ahead) * 24
+    mean_trip_hours = 24 * sum(d * w for d, w in zip(*SEED_TRIP_DAYS)) / sum(SEED_TRIP_DAYS[1])
+    capacity = int(window_hours * SEED_MAX_UTILIZATION / mean_trip_hours)
+    counts = seed_booking_counts([bookings * weight / total_popularity for weight in popularity], capacity)
+    booking_rows = []
+    for (car_id, price), count in zip(car_list, counts):
+        durations = [24 * d for d in rng.choices(*SEED_TRIP_DAYS, k=count)]
+        while sum(durations) > window_hours * SEED_MAX_UTILIZATION: durations.pop()
+        # The idle hours left over are split into random gaps before, between and after the trips
+        gaps = [rng.expovariate(1.0) for _ in range(len(durations) + 1)]
+        scale = (window_hours - sum(durations)) / sum(gaps)
+        cursor = window_start
+        for hours, gap in zip(durations, gaps):
+            start = cursor + timedelta(hours=int(gap * scale))
+            end = start + timedelta(hours=hours)
+            with_driver = rng.random() < 0.2
+            delivery = rng.random() < 0.3
+            delivery_fee = 500 if delivery and not with_driver else 0
+            base_cost = hours * price
+            payment_method = rng.choices(['upi', 'card', 'cod'], [55, 30, 15])[0]
+            status = 'Cancelled' if rng.random() < 0.08 else ('Confirmed' if payment_method == 'cod' else 'Paid')
+            booking_rows.append(dict(
+                user_id=rng.choice(user_ids), car_id=car_id, status=status, base_cost=base_cost,
+                driver_cost=500 if with_driver else 0, discount=0, delivery_type='Delivery' if delivery else 'Pickup',
+                delivery_address='Seeded address' if delivery else 'Self Pickup', delivery_fee=delivery_fee,
+                total_cost=base_cost + (500 if with_driver else 0) + delivery_fee + 648, with_driver=with_driver,
+                payment_method=payment_method, start_date=start, end_date=end,
+                date_booked=min(now, start - timedelta(hours=rng.randrange(1, 24 * 21)))))
+            cursor = end
+    insert_batches(Booking, booking_rows, batch_size)
+
+    past = [b for b in booking_rows if b['end_date'] < now and b['status'] != 'Cancelled']
+    review_rows = [dict(user_id=b['user_id'], car_id=b['car_id'], rating=rng.choices([5, 4, 3, 2, 1], [50, 30, 12, 5, 3])[0],
+                        comment='Seeded review', date_posted=b['end_date'] + timedelta(hours=rng.randrange(1, 72)))
+                   for b in rng.sample(past, min(reviews, len(past)))]
+    insert_batches(Review, review_rows, batch_size)
+
+    recompute_ratings()
+    reconcile_stats()
+    bump_version('cars')
+    bump_version('reviews')
+    bump_version('bookings')
+    db.session.commit()
+    print(f"Seeded {len(car_rows)} cars, {len(user_rows)} users, {len(booking_rows)} bookings and {len(review_rows)} reviews.")
+    if len(booking_rows) < bookings * 0.95:
+        print(f"Only {len(booking_rows)} of {bookings} bookings fit in {days + ahead} days; add --cars or --days for more.")
+
+EXPLAIN_QUERIES = [
+    ('availability', "SELECT id FROM booking WHERE car_id = :car_id AND status != 'Cancelled' AND start_date < :end AND end_date > :start"),
+    ('my_bookings', "SELECT id FROM booking WHERE user_id = :user_id ORDER BY date_booked DESC, id DESC LIMIT 51"),
+    ('manage_bookings', "SELECT id FROM booking ORDER BY date_booked DESC, id DESC LIMIT 51"),
+    ('revenue', "SELECT SUM(total_cost) FROM booking WHERE status != 'Cancelled'"),
+    ('pending_kyc', "SELECT id FROM \"user\" WHERE kyc_status = 'Pending'"),
+    ('fleet', "SELECT id FROM car WHERE is_available = :available AND location = :location AND category = :category"),
+]
+
+@app.cli.command('explain-db')
+def explain_db():
+    """Print the query plan the database picks for each hot query."""
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    params = {'car_id': 1, 'user_id': 1, 'start': datetime.utcnow(), 'end': datetime.utcnow() + timedelta(days=1),
+              'available': True, 'location': 'Mumbai', 'category': 'SUV'}
+    for name, sql in EXPLAIN_QUERIES:
+        print(f'== {name}')
+        for row in db.session.execute(db.text(prefix + sql), params):
+            print('   ' + str(row[-1]))
+
 # --- Reset DB ---
 @app.route('/reset-db')
 def reset_db():
@@ -576,11 +2673,18 @@ def reset_db():
                 Car(name="Mahindra Thar", category="SUV", price_per_hr=180, transmission="Manual", fuel_type="Diesel", seats=4, location="Bangalore", image_url="https://images.unsplash.com/photo-1632245889029-e41314320873?w=600")
             ]
             db.session.add_all(cars)
-            admin = User(name="Admin User", email="admin@drivex.com", password=generate_password_hash("admin123", method='pbkdf2:sha256'), is_admin=True, kyc_status='Verified')
+            admin = User(name="Admin User", email="admin@drivex.com", password=generate_password_hash("admin123", method=app.config['PASSWORD_HASH_METHOD']), is_admin=True, kyc_status='Verified')
             db.session.add(admin)
             c1 = Coupon(code="WELCOME20", discount_amount=200)
             db.session.add(c1)
+            bump_version('cars')
+            bump_version('reviews')
             db.session.commit()
+            reconcile_stats()
+        availability.invalidate()
+        fleet_facets.invalidate()
+        car_prices.invalidate()
+        active_coupons.invalidate()
     return "Database has been reset! Cars are now distributed in Mumbai, Delhi, and Bangalore. Please <a href='/register'>Register Again</a>."
 
 if __name__ == '__main__':
@@ -0,0 +1,345 @@
+"""Route-level benchmark for DriveX.
+
+Drives the hot pages through the Flask test client against the database in
+DATABASE_URL (seed it first with `flask --app app seed-data`) and reports
+p50/p95/p99 latency, SQL queries per request and peak Python memory.
+
+    python bench.py                         # print results
+    python bench.py --save bench_baseline.json
+    python bench.py --baseline bench_baseline.json --tolerance 0.2
+
+With --baseline the run exits non-zero when a route's p95 grows by more than
+the tolerance or it issues more queries than before.
+
+    python bench.py --chatbot               # chatbot matcher cost vs. intent count
+    python bench.py --race --threads 16     # many users confirm one car at once; exactly one may win
+                                            # and a capped coupon is never over-redeemed
+
+--race adds scratch cars, users and a coupon, checks the outcome, then deletes them and
+reconciles the dashboard counters. Run it against a scratch database.
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from werkzeug.security import generate_password_hash
+
+from app import (app, db, Car, User, Booking, BookingHold, Job, Coupon, CouponRedemption, IntentMatcher, pricing, sign_quote,
+                 reconcile_stats, bump_version)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def build_routes():
+    with app.app_context():
+        car = Car.query.filter_by(is_available=True).order_by(Car.id).first()
+        location = car.location if car else 'Mumbai'
+        car_id = car.id if car else 1
+    start = (datetime.utcnow() + timedelta(days=60)).replace(hour=10, minute=0, second=0, microsecond=0)
+    search = f"location={location}&start_date={start:%Y-%m-%d}&end_date={start + timedelta(days=3):%Y-%m-%d}"
+    quote = {'start_date': f'{start:%Y-%m-%dT%H:%M}', 'end_date': f'{start + timedelta(days=2):%Y-%m-%dT%H:%M}'}
+    return [
+        ('home', 'GET', '/', None),
+        ('fleet', 'GET', '/fleet', None),
+        ('fleet_search', 'GET', f'/fleet?{search}', None),
+        ('admin_dashboard', 'GET', '/admin', None),
+        ('manage_bookings', 'GET', '/admin/bookings', None),
+        ('manage_users', 'GET', '/admin/users', None),
+        ('book_car_dates', 'GET', f'/book/{car_id}', None),
+        ('book_car_quote', 'POST', f'/book/{car_id}', quote),
+    ]
+
+
+def run(args):
+    client = app.test_client()
+    response = client.post('/login', data={'email': args.email, 'password': args.password})
+    if response.status_code != 302:
+        sys.exit('Login failed; pass --email/--password for a verified admin.')
+
+    queries = [0]
+    with app.app_context():
+        engine = db.engine
+
+    def count_query(*_):
+        queries[0] += 1
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    results = {}
+    for name, method, url, data in build_routes():
+        call = (lambda: client.post(url, data=data)) if method == 'POST' else (lambda: client.get(url))
+        for _ in range(args.warmup):
+            call()
+        timings, query_counts = [], []
+        for _ in range(args.requests):
+            queries[0] = 0
+            started = time.perf_counter()
+            response = call()
+            timings.append(time.perf_counter() - started)
+            query_counts.append(queries[0])
+            if response.status_code >= 400:
+                sys.exit(f'{name}: {method} {url} returned {response.status_code}')
+        # Memory is measured on a separate request so tracing doesn't skew the timings
+        tracemalloc.start()
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {
+            'p50_ms': round(percentile(timings, 50) * 1000, 2),
+            'p95_ms': round(percentile(timings, 95) * 1000, 2),
+            'p99_ms': round(percentile(timings, 99) * 1000, 2),
+            'queries': round(statistics.mean(query_counts), 1),
+            'peak_kb': round(peak / 1024, 1),
+            'bytes': len(response.data),
+        }
+    event.remove(engine, 'before_cursor_execute', count_query)
+
+    # Quotes place reservation holds; drop the ones this run created
+    with app.app_context():
+        BookingHold.query.filter(BookingHold.start_date >= datetime.utcnow() + timedelta(days=59)).delete()
+        db.session.commit()
+    return results
+
+
+CHAT_MESSAGES = [
+    'hi', 'what are your prices for an suv', 'how do I book a car for the weekend',
+    'which documents do I need', 'can I get a driver with the car', 'is home delivery available in pune',
+    'do you have any coupon codes', 'I want to cancel my booking and get a refund',
+    'this is a long message that mentions nothing the bot knows about at all, just to see the fallback path',
+]
+# Messages where a broad intent (booking, pricing) must not win over the specific one
+CHAT_EXPECTED = [
+    ('cancel my booking', 'cancellation'), ('how do I cancel a reservation', 'cancellation'),
+    ('can I reschedule my booking', 'cancellation'), ('I want to book a car', 'booking'),
+    ('what is the price of a booking', 'pricing'), ('do you deliver the car to my home', 'delivery'),
+    ('can I book with a driver', 'chauffeur'), ('hi, which cities are you in', 'locations'),
+]
+
+
+def chatbot_bench(args):
+    # Synthetic intents on top of the real file: the per-message cost should stay flat as they grow
+    with open(app.config['CHATBOT_INTENTS'], encoding='utf-8') as f:
+        base = json.load(f)
+    matcher = IntentMatcher(base)
+    wrong = [(message, expected, (matcher.match(message)[0] or {}).get('name'))
+             for message, expected in CHAT_EXPECTED if (matcher.match(message)[0] or {}).get('name') != expected]
+    for message, expected, got in wrong:
+        print(f'MISMATCH {message!r}: expected {expected}, got {got}')
+    if wrong:
+        sys.exit(1)
+    rng = random.Random(7)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9))) for _ in range(20000)]
+    print(f"{'intents':>8}{'compile ms':>12}{'us/message':>12}")
+    for count in (10, 100, 1000, 5000):
+        intents = list(base['intents']) + [{
+            'name': f'synthetic-{i}', 'response': 'x',
+            'patterns': [' '.join(rng.sample(vocabulary, rng.randint(1, 3))) + rng.choice(['', '*']) for _ in range(5)],
+        } for i in range(count)]
+        started = time.perf_counter()
+        matcher = IntentMatcher({'fallback': base['fallback'], 'intents': intents})
+        compile_ms = (time.perf_counter() - started) * 1000
+        rounds = max(1, args.requests * 20)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in CHAT_MESSAGES:
+                matcher.match(message)
+        per_message = (time.perf_counter() - started) / (rounds * len(CHAT_MESSAGES)) * 1e6
+        print(f'{len(intents):>8}{compile_ms:>12.1f}{per_message:>12.1f}')
+
+
+RACE_EMAIL = 'race-{}@bench.invalid'
+RACE_COUPON = 'RACECAP'
+
+
+def race_setup(threads):
+    with app.app_context():
+        # One car per racer for the coupon round, where everyone books a different car
+        cars = [Car(name='Race Car', category='SUV', price_per_hr=100, image_url='race.jpg', location='Pune') for _ in range(threads)]
+        users = [User(name=f'Racer {i}', email=RACE_EMAIL.format(i), kyc_status='Verified',
+                      password=generate_password_hash('race', method=app.config['PASSWORD_HASH_METHOD']))
+                 for i in range(threads)]
+        db.session.add_all(cars + users)
+        db.session.commit()
+        car_ids, user_ids = [car.id for car in cars], [user.id for user in users]
+    clients = []
+    for i in range(threads):
+        client = app.test_client()
+        if client.post('/login', data={'email': RACE_EMAIL.format(i), 'password': 'race'}).status_code != 302:
+            sys.exit(f'Race user {i} could not log in.')
+        clients.append(client)
+    return car_ids, list(zip(clients, user_ids))
+
+
+def race_cleanup(car_ids, user_ids):
+    with app.app_context():
+        booking_ids = [b for (b,) in db.session.query(Booking.id).filter(Booking.car_id.in_(car_ids))]
+        CouponRedemption.query.filter(CouponRedemption.booking_id.in_(booking_ids)).delete(synchronize_session=False)
+        Coupon.query.filter_by(code=RACE_COUPON).delete()
+        bump_version('coupons')
+        payloads = [json.dumps({'booking_id': b}) for b in booking_ids]
+        Job.query.filter(Job.kind == 'booking_email', Job.payload.in_(payloads)).delete(synchronize_session=False)
+        Booking.query.filter(Booking.car_id.in_(car_ids)).delete(synchronize_session=False)
+        BookingHold.query.filter(BookingHold.car_id.in_(car_ids)).delete(synchronize_session=False)
+        User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        Car.query.filter(Car.id.in_(car_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        reconcile_stats()
+
+
+def race_round(racers, attempt):
+    # Every thread waits at the barrier so the confirms hit the database together
+    barrier = threading.Barrier(len(racers))
+    outcomes = []
+
+    def run(client, user_id):
+        barrier.wait()
+        outcomes.append(attempt(client, user_id))
+    threads = [threading.Thread(target=run, args=racer) for racer in racers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def confirmed(response):
+    return '/booking/success' in response.headers.get('Location', '')
+
+
+def race_bench(args):
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    car_ids, racers = race_setup(args.threads)
+    car_id = car_ids[0]
+    start = (datetime.utcnow() + timedelta(days=90)).replace(hour=10, minute=0, second=0, microsecond=0)
+    end = start + timedelta(days=2)
+    dates = {'start_date': f'{start:%Y-%m-%dT%H:%M}', 'end_date': f'{end:%Y-%m-%dT%H:%M}'}
+
+    def through_hold(client, user_id):
+        # The normal flow: quote (which places the hold), then confirm with it
+        page = client.post(f'/book/{car_id}', data=dates)
+        if page.status_code != 200: return False
+        html = page.get_data(as_text=True)
+        form = {name: re.search(f'name="{name}" value="([^"]*)"', html).group(1) for name in ('hold_token', 'quote_token')}
+        return confirmed(client.post(f'/book/confirm/{car_id}', data=dict(form, payment_method='card')))
+
+    with app.test_request_context():
+        quotes = {user_id: sign_quote(pricing.quote(car_id, start, end), user_id, start, end, False, 'Self Pickup')
+                  for _, user_id in racers}
+
+    def without_hold(client, user_id):
+        # Every thread already holds a valid quote, so only convert_hold's lock stands between them
+        return confirmed(client.post(f'/book/confirm/{car_id}', data={'quote_token': quotes[user_id], 'payment_method': 'card'}))
+
+    def with_coupon(client, user_id):
+        # Each racer books its own car, so only the coupon's redemption cap can turn them away
+        own_car = car_ids[[uid for _, uid in racers].index(user_id)]
+        with app.test_request_context():
+            quote = pricing.quote(own_car, start, end, coupon_code=RACE_COUPON)
+            token = sign_quote(quote, user_id, start, end, False, 'Self Pickup')
+        return confirmed(client.post(f'/book/confirm/{own_car}', data={'quote_token': token, 'payment_method': 'card'}))
+
+    failures = []
+    try:
+        for name, attempt in (('hold', through_hold), ('direct', without_hold)):
+            started = time.perf_counter()
+            outcomes = race_round(racers, attempt)
+            elapsed = time.perf_counter() - started
+            with app.app_context():
+                rows = Booking.query.filter_by(car_id=car_id).count()
+                Booking.query.filter_by(car_id=car_id).delete()
+                BookingHold.query.filter_by(car_id=car_id).delete()
+                db.session.commit()
+            print(f'{name:<8}{len(racers)} threads, {outcomes.count(True)} confirmed, {rows} bookings in {elapsed * 1000:.0f}ms')
+            if outcomes.count(True) != 1 or rows != 1:
+                failures.append(f'DOUBLE BOOKING {name}: {outcomes.count(True)} confirmed, {rows} bookings')
+
+        with app.app_context():
+            db.session.add(Coupon(code=RACE_COUPON, discount_amount=100, max_redemptions=args.coupon_cap))
+            bump_version('coupons')
+            db.session.commit()
+        started = time.perf_counter()
+        outcomes = race_round(racers, with_coupon)
+        elapsed = time.perf_counter() - started
+        with app.app_context():
+            coupon = Coupon.query.filter_by(code=RACE_COUPON).one()
+            rows = Booking.query.filter_by(coupon_code=RACE_COUPON).count()
+            ledger = CouponRedemption.query.filter_by(coupon_id=coupon.id).count()
+            redemptions = coupon.redemptions
+        print(f'{"coupon":<8}{len(racers)} threads, cap {args.coupon_cap}, {outcomes.count(True)} confirmed, '
+              f'{redemptions} redemptions, {rows} bookings, {ledger} ledger rows in {elapsed * 1000:.0f}ms')
+        expected = min(args.coupon_cap, len(racers))
+        if not outcomes.count(True) == redemptions == rows == ledger == expected:
+            failures.append(f'OVER-REDEEMED coupon: {redemptions} redemptions of {args.coupon_cap}, {rows} bookings')
+    finally:
+        race_cleanup(car_ids, [user_id for _, user_id in racers])
+    for line in failures:
+        print(line)
+    if failures:
+        sys.exit(1)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {current['queries']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per route')
+    parser.add_argument('--email', default='admin@drivex.com')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 growth before failing')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--chatbot', action='store_true', help='benchmark the chatbot matcher instead of the routes')
+    parser.add_argument('--race', action='store_true', help='race concurrent bookings for one car instead of timing routes')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent users for --race')
+    parser.add_argument('--coupon-cap', type=int, default=3, help='max redemptions of the --race coupon')
+    args = parser.parse_args()
+
+    if args.chatbot:
+        chatbot_bench(args)
+        return
+    if args.race:
+        race_bench(args)
+        return
+
+    results = run(args)
+    print(f"{'route':<18}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KB':>10}{'bytes':>10}")
+    for name, r in results.items():
+        print(f"{name:<18}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['queries']:>9}{r['peak_kb']:>10}{r['bytes']:>10}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()